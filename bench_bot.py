@@ -0,0 +1,296 @@
+# -*- coding: utf-8 -*-
+"""
+Офлайн нагрузочный тест / бенчмарк для game_awards_bot.py.
+
+Гоняет poll_answer_handler, button_router и text_message_handler на синтетических
+Update с заданной частотой. Вместо Bot API — локальная заглушка FakeBot, которая
+записывает вызовы (send_poll, send_message, get_chat_member, ...) и имитирует
+сетевую задержку. Сеть и токен не нужны; БД — временный файл.
+
+Запуск:
+    python bench_bot.py                                   # 10k голосующих, 50 опросов
+    python bench_bot.py --voters 2000 --polls 10 --rate 5000 --api-latency-ms 20
+    python bench_bot.py --changes 0.3 --concurrency 8     # 30% меняют голос, 8 апдейтов параллельно
+
+Отчёт: пропускная способность, p50/p95/p99 задержки хендлеров, число
+транзакций/изменённых строк в БД и вызовов API, сверка числа голосов в БД.
+"""
+
+import argparse
+import asyncio
+import math
+import os
+import random
+import sys
+import tempfile
+import time
+from collections import Counter, defaultdict
+from types import SimpleNamespace
+from typing import Dict, List
+
+
+class FakeMessage:
+    """То, что «вернул» Telegram на send_message/send_poll: хватает для reply_text/edit_text."""
+
+    _ids = 0
+
+    def __init__(self, bot: "FakeBot", chat_id: int, poll_id: str = None):
+        FakeMessage._ids += 1
+        self.message_id = FakeMessage._ids
+        self.chat_id = chat_id
+        self.poll = SimpleNamespace(id=poll_id) if poll_id else None
+        self._bot = bot
+
+    async def reply_text(self, text, **kwargs):
+        return await self._bot.send_message(chat_id=self.chat_id, text=text, **kwargs)
+
+    async def edit_text(self, text, **kwargs):
+        return await self._bot.edit_message_text(chat_id=self.chat_id, message_id=self.message_id, text=text, **kwargs)
+
+
+class FakeBot:
+    """Локальная заглушка Bot API: считает вызовы и спит api_latency секунд на каждом."""
+
+    def __init__(self, api_latency: float, admin_ids: List[int]):
+        self.api_latency = api_latency
+        self.admin_ids = admin_ids
+        self.calls: Counter = Counter()
+        self._polls = 0
+        self.defaults = None  # telegram.Bot.defaults — PTB читает его при разборе апдейтов
+
+    async def _call(self, method: str):
+        self.calls[method] += 1
+        if self.api_latency:
+            await asyncio.sleep(self.api_latency)
+
+    async def send_poll(self, chat_id, **kwargs):
+        await self._call("send_poll")
+        self._polls += 1
+        return FakeMessage(self, chat_id, poll_id=f"bench-poll-{self._polls}")
+
+    async def send_message(self, chat_id, text=None, **kwargs):
+        await self._call("send_message")
+        return FakeMessage(self, chat_id)
+
+    async def get_chat_member(self, chat_id, user_id, **kwargs):
+        await self._call("get_chat_member")
+        return SimpleNamespace(status="administrator" if user_id in self.admin_ids else "member")
+
+    async def get_chat_administrators(self, chat_id, **kwargs):
+        await self._call("get_chat_administrators")
+        return [SimpleNamespace(user=SimpleNamespace(id=uid), status="administrator") for uid in self.admin_ids]
+
+    def __getattr__(self, method: str):
+        # любой другой метод API (answer_callback_query, edit_message_*, send_document, stop_poll, ...)
+        if method.startswith("_"):
+            raise AttributeError(method)
+
+        async def call(*args, **kwargs):
+            await self._call(method)
+            return FakeMessage(self, kwargs.get("chat_id", 0))
+
+        return call
+
+
+class FakeApplication:
+    """Минимум от telegram.ext.Application, которым пользуются хендлеры."""
+
+    def __init__(self):
+        self.tasks: List[asyncio.Task] = []
+        self.handlers: Dict[int, list] = {}
+
+    def create_task(self, coroutine):
+        task = asyncio.create_task(coroutine)
+        self.tasks.append(task)
+        return task
+
+
+class WriteCounter:
+    """sqlite3 trace callback: считает транзакции и пишущие запросы (включая тела триггеров)."""
+
+    WRITE_PREFIXES = ("INSERT", "UPDATE", "DELETE")
+
+    def __init__(self):
+        self.commits = 0
+        self.writes = 0
+
+    def __call__(self, statement: str):
+        head = statement.lstrip().upper()
+        if head.startswith("COMMIT"):
+            self.commits += 1
+        elif head.startswith(self.WRITE_PREFIXES):
+            self.writes += 1
+
+
+def percentile(sorted_values: List[float], p: float) -> float:
+    if not sorted_values:
+        return 0.0
+    return sorted_values[max(0, math.ceil(p * len(sorted_values)) - 1)]
+
+
+def user_dict(uid: int) -> dict:
+    return {"id": uid, "is_bot": False, "first_name": f"user{uid}"}
+
+
+def chat_dict(chat_id: int) -> dict:
+    return {"id": chat_id, "type": "group" if chat_id < 0 else "private", "title": "bench"}
+
+
+async def run(args) -> int:
+    import game_awards_bot as bot_module
+    from telegram import Update
+
+    chat_id = -1000
+    admin_id = 1
+    fake = FakeBot(args.api_latency_ms / 1000.0, [admin_id])
+    application = FakeApplication()
+    update_ids = iter(range(1, 10 ** 9))
+    now = int(time.time())
+
+    def context(cmd_args=None):
+        return SimpleNamespace(bot=fake, args=cmd_args or [], application=application)
+
+    def poll_answer(poll_id: str, uid: int, option: int):
+        return Update.de_json({
+            "update_id": next(update_ids),
+            "poll_answer": {"poll_id": poll_id, "user": user_dict(uid), "option_ids": [option]},
+        }, fake)
+
+    def callback(uid: int, data: str):
+        return Update.de_json({
+            "update_id": next(update_ids),
+            "callback_query": {
+                "id": str(next(update_ids)),
+                "from": user_dict(uid),
+                "chat_instance": "bench",
+                "data": data,
+                "message": {"message_id": 1, "date": now, "chat": chat_dict(chat_id), "text": "menu"},
+            },
+        }, fake)
+
+    def text_message(uid: int, text: str):
+        n = next(update_ids)
+        return Update.de_json({
+            "update_id": n,
+            "message": {"message_id": n, "date": now, "chat": chat_dict(chat_id), "from": user_dict(uid), "text": text},
+        }, fake)
+
+    bot_module.init_db()
+    counter = WriteCounter()
+    bot_module.db.run_sync(lambda con: con.set_trace_callback(counter))
+    bot_module.vote_ingestor.start()
+
+    # --- подготовка: категория и игры через те же кнопки и ввод текста, что у пользователей ---
+    latencies: Dict[str, List[float]] = defaultdict(list)
+
+    async def timed(name: str, handler, update, ctx):
+        t = time.perf_counter()
+        await handler(update, ctx)
+        latencies[name].append(time.perf_counter() - t)
+
+    await timed("button_router", bot_module.button_router, callback(admin_id, "suggest_category"), context())
+    await timed("text_message_handler", bot_module.text_message_handler, text_message(admin_id, "Bench category"), context())
+    cat_id = (await bot_module.list_categories(chat_id))[-1][0]
+    games = args.polls * args.options
+    for i in range(games):
+        await timed("button_router", bot_module.button_router, callback(admin_id, f"suggest_game_cat:{cat_id}"), context())
+        await timed("text_message_handler", bot_module.text_message_handler, text_message(admin_id, f"Game {i:05d}"), context())
+        pending = bot_module.conversation_store.get(chat_id, admin_id)
+        if pending is not None and pending.kind == "confirm_game_for_cat":
+            # "Game 00001" похожа на "Game 00000" — подтверждаем добавление кнопкой
+            await timed("button_router", bot_module.button_router, callback(admin_id, "dup_add"), context())
+
+    # публикация опросов через обычную кнопку; сама рассылка идёт фоновой задачей
+    await timed("button_router", bot_module.button_router, callback(admin_id, f"create_poll_cat:{cat_id}"), context())
+    await timed("button_router", bot_module.button_router, callback(admin_id, f"poll_go:{cat_id}:0"), context())
+    await asyncio.gather(*application.tasks)
+    application.tasks.clear()
+    poll_ids = [row[1] for row in await bot_module.list_active_polls(chat_id)]
+    print(f"Подготовка: {games} игр, {len(poll_ids)} опросов, API: {dict(fake.calls)}")
+
+    # --- шторм голосов ---
+    rng = random.Random(args.seed)
+    updates = []
+    for uid in range(1000, 1000 + args.voters):
+        for poll_id in poll_ids:
+            updates.append(poll_answer(poll_id, uid, rng.randrange(args.options)))
+            if rng.random() < args.changes:
+                updates.append(poll_answer(poll_id, uid, rng.randrange(args.options)))
+    rng.shuffle(updates)
+    expected_votes = args.voters * len(poll_ids)
+
+    commits_before, writes_before = counter.commits, counter.writes
+    calls_before = sum(fake.calls.values())
+    semaphore = asyncio.Semaphore(args.concurrency)
+    in_flight = set()
+
+    async def process(update):
+        try:
+            await timed("poll_answer_handler", bot_module.poll_answer_handler, update, context())
+        finally:
+            semaphore.release()
+
+    print(f"Шторм: {len(updates)} ответов от {args.voters} голосующих в {len(poll_ids)} опросах...")
+    t_start = time.perf_counter()
+    for i, update in enumerate(updates):
+        if args.rate:
+            delay = t_start + i / args.rate - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        await semaphore.acquire()
+        task = asyncio.create_task(process(update))
+        in_flight.add(task)
+        task.add_done_callback(in_flight.discard)
+    await asyncio.gather(*in_flight)
+    t_handled = time.perf_counter()
+    await bot_module.vote_ingestor.stop()
+    t_durable = time.perf_counter()
+
+    stored = (await bot_module.db.query("SELECT COUNT(*) FROM votes"))[0][0]
+    tallied = (await bot_module.db.query("SELECT COALESCE(SUM(votes), 0) FROM vote_tallies"))[0][0]
+    bot_module.db.close()
+
+    # --- отчёт ---
+    print()
+    print(f"Обработано ответов:       {len(updates)} за {t_handled - t_start:.3f} с "
+          f"({len(updates) / max(t_handled - t_start, 1e-9):,.0f} апдейтов/с)")
+    print(f"До записи на диск:        {t_durable - t_start:.3f} с")
+    for name, values in latencies.items():
+        values.sort()
+        print(f"{name:26s}n={len(values):<8d} p50={percentile(values, 0.50) * 1000:.3f} мс  "
+              f"p95={percentile(values, 0.95) * 1000:.3f} мс  p99={percentile(values, 0.99) * 1000:.3f} мс")
+    print(f"БД за шторм:              {counter.commits - commits_before} транзакций, "
+          f"{counter.writes - writes_before} пишущих запросов (с триггерами)")
+    print(f"Вызовов API за шторм:     {sum(fake.calls.values()) - calls_before}; всего {dict(fake.calls)}")
+    ok = stored == expected_votes and tallied == expected_votes
+    print(f"Голосов в БД: {stored}, в vote_tallies: {tallied}, ожидалось {expected_votes} — {'OK' if ok else 'РАСХОЖДЕНИЕ'}")
+    return 0 if ok else 1
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Офлайн бенчмарк game_awards_bot с заглушкой Bot API")
+    parser.add_argument("--voters", type=int, default=10000, help="число голосующих")
+    parser.add_argument("--polls", type=int, default=50, help="число опросов")
+    parser.add_argument("--options", type=int, default=10, help="вариантов в опросе (не больше MAX_POLL_OPTIONS)")
+    parser.add_argument("--changes", type=float, default=0.1, help="доля ответов, которые потом меняют голос")
+    parser.add_argument("--rate", type=float, default=0, help="апдейтов в секунду (0 — без ограничения)")
+    parser.add_argument("--concurrency", type=int, default=1, help="сколько апдейтов обрабатывать одновременно")
+    parser.add_argument("--api-latency-ms", type=float, default=0, help="имитируемая задержка Bot API")
+    parser.add_argument("--db", help="файл БД (по умолчанию — временный)")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # настройки бота читаются при импорте — выставляем до него
+        os.environ["DB_PATH"] = args.db or os.path.join(tmp, "bench.db")
+        os.environ.setdefault("TELEGRAM_TOKEN", "bench")
+        # лимиты flood-control Telegram к заглушке не относятся — не ждём их при публикации опросов
+        os.environ.setdefault("TG_GROUP_MSGS_PER_MIN", "1000000")
+        os.environ.setdefault("TG_GLOBAL_MSGS_PER_SEC", "1000000")
+        import logging
+        logging.disable(logging.INFO)
+        sys.exit(asyncio.run(run(args)))
+
+
+if __name__ == "__main__":
+    main()
@@ -2,7 +2,7 @@
 """
 Game Awards Telegram Bot
 Автор: (пример)
-Требует: python-telegram-bot==20.x, pandas, python-docx, openpyxl, reportlab
+Требует: python-telegram-bot==20.x, python-docx, openpyxl, reportlab
 Запуск:
     set TELEGRAM_TOKEN=8413467526:AAFukjD4IkPniFbFBRiW5mCip_gpeLIoZNk     (Windows cmd)
     # или в PowerShell:
@@ -10,39 +10,104 @@ Game Awards Telegram Bot
     python game_awards_bot.py
 """
 
+import time
+
+_T_START = time.perf_counter()  # для STARTUP_PROFILE: отсчёт от начала импорта модуля
+
 import os
 import sqlite3
 import json
+import csv
+import asyncio
+import bisect
+import functools
+import importlib
 import logging
-from datetime import datetime
-from typing import Dict, List, Tuple
+import math
+import multiprocessing
+import shutil
+import tempfile
+import threading
+import unicodedata
+from array import array
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple, Union
 
 from telegram import (
     Update,
     InlineKeyboardButton,
     InlineKeyboardMarkup,
+    InlineQueryResultArticle,
+    InputTextMessageContent,
     Poll,
+    PollAnswer,
 )
 from telegram.ext import (
     Application, # <--- ИСПОЛЬЗУЕМ Application
     ApplicationBuilder, # <--- ИСПОЛЬЗУЕМ ApplicationBuilder
+    ApplicationHandlerStop,
+    BaseUpdateProcessor,
     ContextTypes,
     CommandHandler,
     CallbackQueryHandler,
+    ChatMemberHandler,
+    InlineQueryHandler,
     MessageHandler,
+    TypeHandler,
     filters,
 )
+from telegram.error import RetryAfter
+from telegram.request import HTTPXRequest
 
-import pandas as pd
-from docx import Document
-from reportlab.lib.pagesizes import A4
-from reportlab.pdfgen import canvas
+# python-docx / openpyxl / reportlab импортируются лениво внутри сборщиков экспорта
+_T_IMPORTED = time.perf_counter()
 
 # ------- Настройки -------
 TOKEN = os.getenv("TELEGRAM_TOKEN")  # берём из переменных окружения
-DB_PATH = "game_awards.db"
+DB_PATH = os.getenv("DB_PATH", "game_awards.db")
+# отдельный файл для сырых голосов закрытых опросов (по умолчанию рядом с основной БД)
+ARCHIVE_DB_PATH = os.getenv("ARCHIVE_DB_PATH") or f"{os.path.splitext(DB_PATH)[0]}_archive.db"
+BACKUP_DIR = os.getenv("BACKUP_DIR", "backups")  # куда /backup складывает снимки БД
+BACKUP_KEEP = int(os.getenv("BACKUP_KEEP", "5"))  # сколько последних снимков хранить
+LEGACY_CHAT_ID = int(os.getenv("LEGACY_CHAT_ID", "0"))  # чат, которому отдать категории/опросы, созданные до разделения по чатам (0 — не отдавать)
+# операторы бота (user_id через запятую): только им доступны команды по всей базе — /backup, /rebuild_results, /stats
+OPERATOR_USER_IDS = [int(u) for u in os.getenv("OPERATOR_USER_IDS", "").split(",") if u.strip()]
 ADMIN_USER_IDS = []  # сюда можно записать Telegram user_id админов (опционально). Если пустой - команду может выполнять любой, кто является creator/админ чата (проверяется динамически)
 MAX_POLL_OPTIONS = 10  # Telegram лимит опций в одном poll
+CONV_STATE_TTL = float(os.getenv("CONV_STATE_TTL", "900"))  # сколько секунд ждать ввода после нажатия кнопки
+CONV_STATE_MAX = int(os.getenv("CONV_STATE_MAX", "10000"))  # сколько ожидаемых вводов держать одновременно
+CONV_STATE_PERSIST = os.getenv("CONV_STATE_PERSIST", "1") == "1"  # сохранять ожидаемые вводы в БД (переживают рестарт)
+SIMILAR_TITLE_THRESHOLD = float(os.getenv("SIMILAR_TITLE_THRESHOLD", "0.6"))  # порог похожести названий (триграммы, Жаккар)
+INLINE_RESULTS_LIMIT = 50  # максимум результатов inline-запроса в Bot API
+ADMIN_CACHE_TTL = float(os.getenv("ADMIN_CACHE_TTL", "600"))  # секунд держать список админов чата
+POLL_CACHE_SIZE = int(os.getenv("POLL_CACHE_SIZE", "10000"))  # сколько опросов держать в памяти
+VOTE_FLUSH_SIZE = int(os.getenv("VOTE_FLUSH_SIZE", "500"))  # сколько изменений голосов копить до записи
+VOTE_FLUSH_INTERVAL = float(os.getenv("VOTE_FLUSH_INTERVAL", "0.5"))  # не дольше стольких секунд
+EXPORT_WORKERS = int(os.getenv("EXPORT_WORKERS", "3"))  # процессов для сборки файлов экспорта
+EXPORT_CACHE_VERSIONS = int(os.getenv("EXPORT_CACHE_VERSIONS", "3"))  # сколько версий файлов экспорта хранить
+EXPORT_DOCUMENT_MAX_ROWS = int(os.getenv("EXPORT_DOCUMENT_MAX_ROWS", "5000"))  # голосов в docx/pdf (полный список — в csv/xlsx/jsonl)
+# форматы экспорта через запятую (пусто — все встроенные), например "xlsx,csv" — тогда docx/reportlab можно не ставить
+EXPORT_FORMATS_ENABLED = [f.strip() for f in os.getenv("EXPORT_FORMATS_ENABLED", "").split(",") if f.strip()]
+TG_GLOBAL_MSGS_PER_SEC = float(os.getenv("TG_GLOBAL_MSGS_PER_SEC", "30"))  # общий лимит Bot API на отправку
+TG_GROUP_MSGS_PER_MIN = int(os.getenv("TG_GROUP_MSGS_PER_MIN", "20"))  # лимит сообщений в одну группу
+TG_PRIVATE_MSGS_PER_SEC = float(os.getenv("TG_PRIVATE_MSGS_PER_SEC", "1"))  # лимит сообщений в личный чат
+# Режим работы: если задан WEBHOOK_URL (публичный https-адрес) — вебхук, иначе long polling
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("PORT", "8443"))  # Railway/Heroku передают порт в PORT
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "telegram")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")  # secret_token для проверки, что запрос пришёл от Telegram
+POLL_INTERVAL = float(os.getenv("POLL_INTERVAL", "0"))  # пауза между getUpdates в режиме polling
+CONCURRENT_UPDATES = int(os.getenv("CONCURRENT_UPDATES", "1"))  # >1 — параллельно по разным чатам, по порядку внутри чата
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", "100"))  # запросы к БД дольше этого попадают в лог медленных
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))  # порт HTTP /metrics в формате Prometheus (0 — выключено)
+IMPORT_MAX_ROWS = int(os.getenv("IMPORT_MAX_ROWS", "100000"))  # сколько строк принимать из файла импорта
+POLL_DEADLINE_CHECK_INTERVAL = float(os.getenv("POLL_DEADLINE_CHECK_INTERVAL", "30"))  # как часто искать опросы с истёкшим сроком
+POLL_CLOSE_BATCH = int(os.getenv("POLL_CLOSE_BATCH", "20"))  # сколько опросов закрывать (stop_poll) за одну пачку
+CATCHUP_ON_START = os.getenv("CATCHUP_ON_START", "1") == "1"  # в режиме polling разобрать накопившееся за простой до старта
+STARTUP_PROFILE = os.getenv("STARTUP_PROFILE") == "1"  # залогировать время импорта и до первого обработанного апдейта
 # -------------------------
 
 # Логирование
@@ -52,11 +117,312 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 
+# ---------- Метрики ----------
+class Histogram:
+    """Гистограмма с фиксированными границами корзин (секунды), как в Prometheus."""
+    __slots__ = ("bounds", "counts", "sum", "count")
+
+    BOUNDS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self):
+        self.bounds = self.BOUNDS
+        self.counts = [0] * (len(self.bounds) + 1)  # последняя — +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q: float) -> float:
+        """Оценка квантиля сверху — граница корзины, в которую он попал."""
+        rank, acc = q * self.count, 0
+        for bound, n in zip(self.bounds + (math.inf,), self.counts):
+            acc += n
+            if acc >= rank:
+                return bound
+        return math.inf
+
+
+class Metrics:
+    """Счётчики и гистограммы с метками; потокобезопасно (БД пишет метрики из своего потока).
+
+    Отдаётся двумя путями: /stats в боте и текст в формате Prometheus
+    на METRICS_PORT (см. MetricsServer).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.histograms: Dict[Tuple[str, Tuple], Histogram] = {}
+        self.counters: Dict[Tuple[str, Tuple], float] = {}
+        self.gauges: Dict[str, Callable[[], float]] = {}
+
+    def observe(self, name: str, value: float, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            hist = self.histograms.get(key)
+            if hist is None:
+                hist = self.histograms[key] = Histogram()
+            hist.observe(value)
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def gauge(self, name: str, fn: Callable[[], float]):
+        self.gauges[name] = fn
+
+    @staticmethod
+    def _labels(labels: Tuple, extra: str = "") -> str:
+        parts = [
+            '%s="%s"' % (k, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+            for k, v in labels
+        ]
+        if extra:
+            parts.append(extra)
+        return "{%s}" % ",".join(parts) if parts else ""
+
+    def render_prometheus(self) -> str:
+        lines = []
+        with self._lock:
+            histograms = sorted(self.histograms.items())
+            counters = sorted(self.counters.items())
+            hist_snapshot = [(key, list(h.counts), h.sum, h.count, h.bounds) for key, h in histograms]
+        typed = set()
+        for (name, labels), counts, total, count, bounds in hist_snapshot:
+            if name not in typed:
+                lines.append(f"# TYPE {name} histogram")
+                typed.add(name)
+            acc = 0
+            for bound, n in zip(bounds + (math.inf,), counts):
+                acc += n
+                le = 'le="%s"' % ("+Inf" if bound == math.inf else repr(bound))
+                lines.append(f"{name}_bucket{self._labels(labels, le)} {acc}")
+            lines.append(f"{name}_sum{self._labels(labels)} {total}")
+            lines.append(f"{name}_count{self._labels(labels)} {count}")
+        for (name, labels), value in counters:
+            if name not in typed:
+                lines.append(f"# TYPE {name} counter")
+                typed.add(name)
+            lines.append(f"{name}{self._labels(labels)} {value}")
+        for name, fn in sorted(self.gauges.items()):
+            lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name} {fn()}")
+        return "\n".join(lines) + "\n"
+
+    def summary(self, name: str, label: str, top: int = 10) -> List[Tuple[str, Histogram]]:
+        """Гистограммы метрики name по значению метки label, самые «дорогие» (по сумме времени) первыми."""
+        with self._lock:
+            rows = [(dict(labels).get(label, ""), h) for (n, labels), h in self.histograms.items() if n == name]
+        rows.sort(key=lambda row: row[1].sum, reverse=True)
+        return rows[:top]
+
+    def counter_value(self, name: str, **labels) -> float:
+        with self._lock:
+            if labels:
+                return self.counters.get((name, tuple(sorted(labels.items()))), 0)
+            return sum(v for (n, _), v in self.counters.items() if n == name)
+
+
+metrics = Metrics()
+
+
+def instrumented(handler: Callable) -> Callable:
+    """Декоратор хендлера: гистограмма bot_handler_seconds и счётчик ошибок по имени хендлера."""
+    name = handler.__name__
+
+    @functools.wraps(handler)
+    async def wrapper(update, context):
+        t0 = time.perf_counter()
+        try:
+            return await handler(update, context)
+        except Exception:
+            metrics.inc("bot_handler_errors_total", handler=name)
+            raise
+        finally:
+            metrics.observe("bot_handler_seconds", time.perf_counter() - t0, handler=name)
+
+    return wrapper
+
+
+class InstrumentedRequest(HTTPXRequest):
+    """HTTPXRequest, который меряет каждый вызов Bot API: bot_api_seconds и bot_api_errors_total по методу."""
+
+    async def do_request(self, url: str, method: str, *args, **kwargs):
+        api_method = url.rsplit("/", 1)[-1]
+        t0 = time.perf_counter()
+        try:
+            code, payload = await super().do_request(url, method, *args, **kwargs)
+        except Exception as e:
+            metrics.inc("bot_api_errors_total", method=api_method, error=type(e).__name__)
+            raise
+        finally:
+            metrics.observe("bot_api_seconds", time.perf_counter() - t0, method=api_method)
+        if code >= 400:
+            metrics.inc("bot_api_errors_total", method=api_method, error=str(code))
+        return code, payload
+
+
+class MetricsServer:
+    """Минимальный HTTP-сервер на asyncio: GET /metrics -> metrics.render_prometheus()."""
+
+    def __init__(self, host: str, port: int):
+        self.host = host
+        self.port = port
+        self._server: Optional[asyncio.AbstractServer] = None
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        logger.info("Метрики Prometheus: http://%s:%s/metrics", self.host, self.port)
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), timeout=5)
+            while (await asyncio.wait_for(reader.readline(), timeout=5)) not in (b"\r\n", b"\n", b""):
+                pass  # заголовки не нужны
+            parts = request_line.decode("latin-1").split()
+            if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] == "/metrics":
+                status, body = "200 OK", metrics.render_prometheus().encode("utf-8")
+            else:
+                status, body = "404 Not Found", b"not found\n"
+            writer.write(
+                f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode("latin-1") + body
+            )
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+
 # ---------- База данных (very small ORM over sqlite3) ----------
-def init_db():
-    con = sqlite3.connect(DB_PATH)
-    cur = con.cursor()
-    cur.execute("""
+def _fetchall(con: sqlite3.Connection, query: str, params=()):
+    return con.execute(query, params).fetchall()
+
+
+def _execute(con: sqlite3.Connection, query: str, params=()) -> int:
+    return con.execute(query, params).rowcount
+
+
+def _executemany(con: sqlite3.Connection, query: str, seq_of_params) -> int:
+    return con.executemany(query, seq_of_params).rowcount
+
+
+def _in_transaction(con: sqlite3.Connection, fn: Callable, *args):
+    con.execute("BEGIN IMMEDIATE")
+    try:
+        res = fn(con, *args)
+    except BaseException:
+        con.execute("ROLLBACK")
+        raise
+    con.execute("COMMIT")
+    return res
+
+
+class Database:
+    """Долгоживущий движок поверх sqlite3.
+
+    Одно постоянное соединение в режиме WAL живёт на выделенном потоке
+    (однопоточный executor): все обращения к БД сериализуются на нём и
+    не блокируют event loop. Хендлеры пользуются awaitable API —
+    query / execute / executemany / transaction; код вне event loop
+    (init_db, скрипты) — блокирующим run_sync. Если задан archive_path,
+    к соединению подключается архив (ATTACH ... AS archive) с сырыми
+    голосами закрытых опросов.
+    """
+
+    def __init__(self, path: str, archive_path: Optional[str] = None):
+        self.path = path
+        self.archive_path = archive_path
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite")
+        self._con: Optional[sqlite3.Connection] = None
+
+    def _connection(self) -> sqlite3.Connection:
+        # вызывается только из потока БД
+        if self._con is None:
+            # isolation_level=None: одиночные запросы коммитятся сразу,
+            # пакеты оборачиваем в явный BEGIN/COMMIT (см. transaction)
+            con = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+            con.execute("PRAGMA journal_mode=WAL")
+            con.execute("PRAGMA synchronous=NORMAL")  # в WAL это безопасно и без fsync на каждый коммит
+            con.execute("PRAGMA busy_timeout=5000")
+            if self.archive_path:
+                con.execute("ATTACH DATABASE ? AS archive", (self.archive_path,))
+                con.execute("PRAGMA archive.journal_mode=WAL")
+                con.execute("PRAGMA archive.synchronous=NORMAL")
+                _create_archive_schema(con)
+            self._con = con
+        return self._con
+
+    def _call(self, fn: Callable, *args):
+        con = self._connection()
+        changes_before = con.total_changes
+        t0 = time.perf_counter()
+        res = fn(con, *args)
+        elapsed = time.perf_counter() - t0
+        # метка — текст запроса для одиночных запросов, имя функции для транзакций
+        if fn is _in_transaction:
+            label = args[0].__name__
+        elif fn in (_fetchall, _execute, _executemany):
+            label = " ".join(args[0].split())[:80]
+        else:
+            label = getattr(fn, "__name__", "db_call")
+        rows = len(res) if fn is _fetchall else con.total_changes - changes_before
+        metrics.observe("bot_db_query_seconds", elapsed, query=label)
+        metrics.inc("bot_db_query_rows_total", rows, query=label)
+        if elapsed * 1000 >= SLOW_QUERY_MS:
+            metrics.inc("bot_db_slow_queries_total", query=label)
+            logger.warning("Медленный запрос к БД: %.1f мс, строк %s: %s", elapsed * 1000, rows, label)
+        return res
+
+    async def run(self, fn: Callable, *args):
+        """Выполнить fn(con, *args) в потоке БД и дождаться результата."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, self._call, fn, *args)
+
+    def run_sync(self, fn: Callable, *args):
+        """Блокирующий вариант run — только для кода вне event loop."""
+        return self._executor.submit(self._call, fn, *args).result()
+
+    async def query(self, query: str, params=()) -> List[Tuple]:
+        return await self.run(_fetchall, query, params)
+
+    async def execute(self, query: str, params=()) -> int:
+        """Выполнить один запрос (autocommit), вернуть rowcount."""
+        return await self.run(_execute, query, params)
+
+    async def executemany(self, query: str, seq_of_params) -> int:
+        """executemany одной транзакцией."""
+        return await self.transaction(_executemany, query, list(seq_of_params))
+
+    async def transaction(self, fn: Callable, *args):
+        """Выполнить fn(con, *args) внутри BEGIN IMMEDIATE ... COMMIT (ROLLBACK при ошибке)."""
+        return await self.run(_in_transaction, fn, *args)
+
+    def close(self):
+        def _close(_con):
+            if self._con is not None:
+                self._con.close()
+                self._con = None
+        self._executor.submit(_close, None).result()
+        self._executor.shutdown(wait=True)
+
+
+db = Database(DB_PATH, ARCHIVE_DB_PATH)
+
+
+# ---------- Миграции схемы ----------
+def _migration_1_base_tables(con: sqlite3.Connection):
+    con.execute("""
     CREATE TABLE IF NOT EXISTS categories(
         id INTEGER PRIMARY KEY AUTOINCREMENT,
         title TEXT UNIQUE,
@@ -65,7 +431,7 @@ def init_db():
         created_at TEXT
     )
     """)
-    cur.execute("""
+    con.execute("""
     CREATE TABLE IF NOT EXISTS games(
         id INTEGER PRIMARY KEY AUTOINCREMENT,
         title TEXT,
@@ -76,7 +442,7 @@ def init_db():
         UNIQUE(title, category_id)
     )
     """)
-    cur.execute("""
+    con.execute("""
     CREATE TABLE IF NOT EXISTS polls(
         id INTEGER PRIMARY KEY AUTOINCREMENT,
         telegram_poll_id TEXT,
@@ -86,7 +452,7 @@ def init_db():
         created_at TEXT
     )
     """)
-    cur.execute("""
+    con.execute("""
     CREATE TABLE IF NOT EXISTS votes(
         id INTEGER PRIMARY KEY AUTOINCREMENT,
         telegram_poll_id TEXT,
@@ -98,122 +464,1312 @@ def init_db():
         voted_at TEXT
     )
     """)
-    con.commit()
-    con.close()
 
 
-def db_execute(query: str, params=(), fetch=False, many=False):
-    con = sqlite3.connect(DB_PATH)
-    cur = con.cursor()
-    if many:
-        cur.executemany(query, params)
-        res = None
-    else:
-        cur.execute(query, params)
-        res = cur.fetchall() if fetch else None
-    con.commit()
-    con.close()
-    return res
+def _migration_2_indexes(con: sqlite3.Connection):
+    # индексы под горячие пути: поиск опроса, замена голоса, игры категории, join-ы экспорта
+    con.execute("CREATE INDEX IF NOT EXISTS idx_polls_tg_id ON polls(telegram_poll_id)")
+    con.execute("CREATE INDEX IF NOT EXISTS idx_polls_active ON polls(active) WHERE active = 1")
+    con.execute("CREATE INDEX IF NOT EXISTS idx_games_category ON games(category_id)")
+    con.execute("CREATE INDEX IF NOT EXISTS idx_votes_game ON votes(game_id)")
+    # старые базы могли накопить дубли (DELETE+INSERT без ограничений) — оставляем последний голос
+    con.execute("""
+    DELETE FROM votes WHERE id NOT IN (
+        SELECT MAX(id) FROM votes GROUP BY telegram_poll_id, user_id, option_index
+    )
+    """)
+    # уникальность голоса; заодно покрывает WHERE telegram_poll_id = ? AND user_id = ?
+    con.execute(
+        "CREATE UNIQUE INDEX IF NOT EXISTS uq_votes_poll_user_option ON votes(telegram_poll_id, user_id, option_index)"
+    )
+
+
+def _rebuild_tallies(con: sqlite3.Connection):
+    con.execute("DELETE FROM vote_tallies")
+    con.execute("""
+    INSERT INTO vote_tallies(telegram_poll_id, game_id, category_id, votes)
+    SELECT v.telegram_poll_id, v.game_id, g.category_id, COUNT(*)
+    FROM votes v
+    LEFT JOIN games g ON v.game_id = g.id
+    GROUP BY v.telegram_poll_id, v.game_id
+    """)
+
+
+def _migration_3_vote_tallies(con: sqlite3.Connection):
+    # агрегат голосов по (опрос, игра); по категории — сумма по её играм.
+    # Поддерживается триггерами на votes, так что любой путь записи голосов его обновляет
+    con.execute("""
+    CREATE TABLE IF NOT EXISTS vote_tallies(
+        telegram_poll_id TEXT NOT NULL,
+        game_id INTEGER NOT NULL,
+        category_id INTEGER,
+        votes INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY(telegram_poll_id, game_id)
+    ) WITHOUT ROWID
+    """)
+    con.execute("CREATE INDEX IF NOT EXISTS idx_tallies_category ON vote_tallies(category_id, game_id)")
+    con.execute("""
+    CREATE TRIGGER IF NOT EXISTS trg_votes_tally_insert AFTER INSERT ON votes
+    BEGIN
+        INSERT INTO vote_tallies(telegram_poll_id, game_id, category_id, votes)
+        VALUES (NEW.telegram_poll_id, NEW.game_id, (SELECT category_id FROM games WHERE id = NEW.game_id), 1)
+        ON CONFLICT(telegram_poll_id, game_id) DO UPDATE SET votes = votes + 1;
+    END
+    """)
+    con.execute("""
+    CREATE TRIGGER IF NOT EXISTS trg_votes_tally_delete AFTER DELETE ON votes
+    BEGIN
+        UPDATE vote_tallies SET votes = votes - 1
+        WHERE telegram_poll_id = OLD.telegram_poll_id AND game_id = OLD.game_id;
+    END
+    """)
+    con.execute("""
+    CREATE TRIGGER IF NOT EXISTS trg_votes_tally_update AFTER UPDATE OF telegram_poll_id, game_id ON votes
+    WHEN OLD.telegram_poll_id IS NOT NEW.telegram_poll_id OR OLD.game_id IS NOT NEW.game_id
+    BEGIN
+        UPDATE vote_tallies SET votes = votes - 1
+        WHERE telegram_poll_id = OLD.telegram_poll_id AND game_id = OLD.game_id;
+        INSERT INTO vote_tallies(telegram_poll_id, game_id, category_id, votes)
+        VALUES (NEW.telegram_poll_id, NEW.game_id, (SELECT category_id FROM games WHERE id = NEW.game_id), 1)
+        ON CONFLICT(telegram_poll_id, game_id) DO UPDATE SET votes = votes + 1;
+    END
+    """)
+    _rebuild_tallies(con)
+
+
+def _migration_4_data_version(con: sqlite3.Connection):
+    # счётчик версии данных: меняется при любой записи в votes/games/categories,
+    # по нему кэш экспорта понимает, устарел ли файл
+    con.execute("""
+    CREATE TABLE IF NOT EXISTS data_version(
+        id INTEGER PRIMARY KEY CHECK (id = 1),
+        version INTEGER NOT NULL
+    )
+    """)
+    con.execute("INSERT OR IGNORE INTO data_version(id, version) VALUES (1, 0)")
+    for table in ("votes", "games", "categories"):
+        _create_version_triggers(con, table)
+
+
+def _create_version_triggers(con: sqlite3.Connection, table: str):
+    for event in ("INSERT", "UPDATE", "DELETE"):
+        con.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS trg_{table}_{event.lower()}_version AFTER {event} ON {table}
+        BEGIN
+            UPDATE data_version SET version = version + 1 WHERE id = 1;
+        END
+        """)
+
+
+def _migration_5_conversation_state(con: sqlite3.Connection):
+    con.execute("""
+    CREATE TABLE IF NOT EXISTS conversation_state(
+        chat_id INTEGER NOT NULL,
+        user_id INTEGER NOT NULL,
+        kind TEXT NOT NULL,
+        value,
+        expires_at REAL NOT NULL,
+        PRIMARY KEY(chat_id, user_id)
+    ) WITHOUT ROWID
+    """)
+
+
+def _migration_6_normalized_titles(con: sqlite3.Connection):
+    # нормализованное название для поиска дублей ("Elden Ring" == "elden ring ")
+    columns = [row[1] for row in con.execute("PRAGMA table_info(games)")]
+    if "normalized_title" not in columns:
+        con.execute("ALTER TABLE games ADD COLUMN normalized_title TEXT")
+    rows = con.execute("SELECT id, title FROM games").fetchall()
+    con.executemany("UPDATE games SET normalized_title = ? WHERE id = ?", [(normalize_title(t or ""), gid) for gid, t in rows])
+    con.execute("CREATE INDEX IF NOT EXISTS idx_games_category_normalized ON games(category_id, normalized_title)")
+
+
+def _migration_7_poll_deadlines(con: sqlite3.Connection):
+    # где опубликован опрос (для stop_poll) и до какого момента он открыт (UTC ISO, NULL — без срока)
+    columns = [row[1] for row in con.execute("PRAGMA table_info(polls)")]
+    for name, decl in (("chat_id", "INTEGER"), ("message_id", "INTEGER"), ("closes_at", "TEXT")):
+        if name not in columns:
+            con.execute(f"ALTER TABLE polls ADD COLUMN {name} {decl}")
+    con.execute("CREATE INDEX IF NOT EXISTS idx_polls_deadline ON polls(closes_at) WHERE active = 1 AND closes_at IS NOT NULL")
+    con.execute("CREATE INDEX IF NOT EXISTS idx_polls_category_active ON polls(category_id) WHERE active = 1")
+
+
+def _migration_8_bot_state(con: sqlite3.Connection):
+    # служебные значения бота: последний применённый update_id и т.п.
+    con.execute("""
+    CREATE TABLE IF NOT EXISTS bot_state(
+        key TEXT PRIMARY KEY,
+        value
+    ) WITHOUT ROWID
+    """)
+
+
+def _migration_9_chat_scope(con: sqlite3.Connection):
+    # категории принадлежат чату (игры и голоса — через категорию, опросы — через polls.chat_id);
+    # названия уникальны в пределах чата, поэтому таблица пересоздаётся с UNIQUE(chat_id, title)
+    con.execute("""
+    CREATE TABLE categories_scoped(
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        chat_id INTEGER,
+        title TEXT,
+        created_by INTEGER,
+        created_by_name TEXT,
+        created_at TEXT,
+        UNIQUE(chat_id, title)
+    )
+    """)
+    # чат старой категории — тот, где публиковались её опросы, если такой чат один
+    con.execute("""
+    INSERT INTO categories_scoped(id, chat_id, title, created_by, created_by_name, created_at)
+    SELECT c.id,
+           (SELECT CASE WHEN COUNT(DISTINCT p.chat_id) = 1 THEN MAX(p.chat_id) END FROM polls p WHERE p.category_id = c.id),
+           c.title, c.created_by, c.created_by_name, c.created_at
+    FROM categories c
+    """)
+    con.execute("DROP TABLE categories")  # вместе с ней уходят и её триггеры data_version
+    con.execute("ALTER TABLE categories_scoped RENAME TO categories")
+    _create_version_triggers(con, "categories")
+    # по rowid внутри chat_id — категории чата сразу идут в порядке id (клавиатуры, экспорт)
+    con.execute("CREATE INDEX IF NOT EXISTS idx_categories_chat ON categories(chat_id)")
+    con.execute("UPDATE polls SET chat_id = (SELECT chat_id FROM categories WHERE id = polls.category_id) WHERE chat_id IS NULL")
+    # (chat_id, category_id) среди активных заменяет оба прежних индекса по active
+    con.execute("DROP INDEX IF EXISTS idx_polls_active")
+    con.execute("DROP INDEX IF EXISTS idx_polls_category_active")
+    con.execute("CREATE INDEX IF NOT EXISTS idx_polls_chat_active ON polls(chat_id, category_id) WHERE active = 1")
+
+
+def _migration_10_poll_results(con: sqlite3.Connection):
+    # итоги заархивированных опросов: сырые голоса уходят в архив (см. archive_polls),
+    # а здесь остаётся одна строка на (опрос, игра)
+    con.execute("""
+    CREATE TABLE IF NOT EXISTS poll_results(
+        telegram_poll_id TEXT NOT NULL,
+        game_id INTEGER NOT NULL,
+        category_id INTEGER,
+        votes INTEGER NOT NULL,
+        PRIMARY KEY(telegram_poll_id, game_id)
+    ) WITHOUT ROWID
+    """)
+    con.execute("CREATE INDEX IF NOT EXISTS idx_poll_results_category ON poll_results(category_id, game_id)")
+    columns = [row[1] for row in con.execute("PRAGMA table_info(polls)")]
+    if "archived_at" not in columns:
+        con.execute("ALTER TABLE polls ADD COLUMN archived_at TEXT")
+    con.execute("CREATE INDEX IF NOT EXISTS idx_polls_unarchived ON polls(id) WHERE active = 0 AND archived_at IS NULL")
+
+
+# (версия, шаг) — только добавлять в конец, уже выпущенные шаги не менять
+MIGRATIONS: List[Tuple[int, Callable[[sqlite3.Connection], None]]] = [
+    (1, _migration_1_base_tables),
+    (2, _migration_2_indexes),
+    (3, _migration_3_vote_tallies),
+    (4, _migration_4_data_version),
+    (5, _migration_5_conversation_state),
+    (6, _migration_6_normalized_titles),
+    (7, _migration_7_poll_deadlines),
+    (8, _migration_8_bot_state),
+    (9, _migration_9_chat_scope),
+    (10, _migration_10_poll_results),
+]
+
+
+def _schema_version(con: sqlite3.Connection) -> int:
+    row = con.execute("SELECT version FROM schema_version").fetchone()
+    return row[0] if row else 0
+
+
+def _set_schema_version(con: sqlite3.Connection, version: int):
+    con.execute("DELETE FROM schema_version")
+    con.execute("INSERT INTO schema_version(version) VALUES (?)", (version,))
+
+
+def _apply_migration(con: sqlite3.Connection, step: Callable[[sqlite3.Connection], None], version: int):
+    step(con)
+    _set_schema_version(con, version)
+
+
+def migrate(con: sqlite3.Connection) -> int:
+    """Довести схему до последней версии. Каждый шаг — отдельная транзакция
+    вместе с записью номера версии, так что прерванный апгрейд продолжится с того же места."""
+    con.execute("CREATE TABLE IF NOT EXISTS schema_version(version INTEGER NOT NULL)")
+    current = _schema_version(con)
+    for version, step in MIGRATIONS:
+        if version <= current:
+            continue
+        logger.info("Миграция схемы БД: %s -> %s (%s)", current, version, step.__name__)
+        _in_transaction(con, _apply_migration, step, version)
+        current = version
+    return current
+
+
+def _adopt_legacy_rows(con: sqlite3.Connection) -> int:
+    """Отдать LEGACY_CHAT_ID категории и опросы без чата; вернуть, сколько категорий осталось без чата."""
+    if LEGACY_CHAT_ID:
+        con.execute("UPDATE categories SET chat_id = ? WHERE chat_id IS NULL", (LEGACY_CHAT_ID,))
+        con.execute("UPDATE polls SET chat_id = ? WHERE chat_id IS NULL", (LEGACY_CHAT_ID,))
+    return con.execute("SELECT COUNT(*) FROM categories WHERE chat_id IS NULL").fetchone()[0]
+
+
+def init_db():
+    db.run_sync(migrate)
+    orphaned = db.run_sync(_in_transaction, _adopt_legacy_rows)
+    if orphaned:
+        logger.warning("Категорий без чата (созданы до разделения по чатам): %s — задайте LEGACY_CHAT_ID, чтобы их вернуть", orphaned)
 
 
 # ---------- Утилиты работы с БД ----------
-def add_category(title: str, user_id: int, user_name: str):
+async def add_category(chat_id: int, title: str, user_id: int, user_name: str):
     now = datetime.utcnow().isoformat()
     try:
-        db_execute(
-            "INSERT INTO categories(title, created_by, created_by_name, created_at) VALUES (?, ?, ?, ?)",
-            (title, user_id, user_name, now),
+        await db.execute(
+            "INSERT INTO categories(chat_id, title, created_by, created_by_name, created_at) VALUES (?, ?, ?, ?, ?)",
+            (chat_id, title, user_id, user_name, now),
         )
-        return True
     except sqlite3.IntegrityError:
         return False
+    category_keyboards.invalidate(chat_id)
+    return True
 
 
-def list_categories() -> List[Tuple]:
-    res = db_execute("SELECT id, title FROM categories ORDER BY id", fetch=True)
+async def list_categories(chat_id: int) -> List[Tuple]:
+    res = await db.query("SELECT id, title FROM categories WHERE chat_id = ? ORDER BY id", (chat_id,))
     return res or []
 
 
-def add_game(title: str, category_id: int, user_id: int, user_name: str):
+def _insert_game(con: sqlite3.Connection, row: Tuple) -> int:
+    return con.execute(
+        "INSERT INTO games(title, normalized_title, category_id, suggested_by, suggested_by_name, suggested_at) VALUES (?, ?, ?, ?, ?, ?)",
+        row,
+    ).lastrowid
+
+
+async def add_game(title: str, category_id: int, user_id: int, user_name: str):
     now = datetime.utcnow().isoformat()
     try:
-        db_execute(
-            "INSERT INTO games(title, category_id, suggested_by, suggested_by_name, suggested_at) VALUES (?, ?, ?, ?, ?)",
-            (title, category_id, user_id, user_name, now),
-        )
-        return True
+        game_id = await db.run(_insert_game, (title, normalize_title(title), category_id, user_id, user_name, now))
     except sqlite3.IntegrityError:
         return False
+    title_index.add(category_id, game_id, title)
+    return True
 
 
-def list_games_for_category(category_id: int) -> List[Tuple]:
-    res = db_execute(
+async def list_games_for_category(category_id: int) -> List[Tuple]:
+    res = await db.query(
         "SELECT id, title, suggested_by_name FROM games WHERE category_id = ? ORDER BY id",
         (category_id,),
-        fetch=True,
     )
     return res or []
 
 
-def store_poll(telegram_poll_id: str, category_id: int, options_map: Dict[int, int]):
-    # options_map: option_index -> game_id
-    now = datetime.utcnow().isoformat()
-    db_execute(
-        "INSERT INTO polls(telegram_poll_id, category_id, options_json, created_at) VALUES (?, ?, ?, ?)",
-        (telegram_poll_id, category_id, json.dumps(options_map), now),
+async def mark_polls_closed(telegram_poll_ids: List[str]):
+    # сначала в памяти — голоса за эти опросы отбрасываются сразу, ещё до записи в БД
+    for telegram_poll_id in telegram_poll_ids:
+        poll_registry.mark_closed(telegram_poll_id)
+    await db.executemany("UPDATE polls SET active = 0 WHERE telegram_poll_id = ?", [(tg_id,) for tg_id in telegram_poll_ids])
+
+
+async def list_active_polls(chat_id: int) -> List[Tuple]:
+    res = await db.query("SELECT id, telegram_poll_id FROM polls WHERE chat_id = ? AND active = 1 ORDER BY id", (chat_id,))
+    return res or []
+
+
+async def list_active_polls_for_category(chat_id: int, category_id: int) -> List[Tuple]:
+    """(telegram_poll_id, chat_id, message_id) активных опросов категории в чате."""
+    res = await db.query(
+        "SELECT telegram_poll_id, chat_id, message_id FROM polls WHERE chat_id = ? AND category_id = ? AND active = 1",
+        (chat_id, category_id),
     )
+    return res or []
 
 
-def mark_poll_closed(telegram_poll_id: str):
-    db_execute("UPDATE polls SET active = 0 WHERE telegram_poll_id = ?", (telegram_poll_id,))
+async def list_expired_polls(limit: int) -> List[Tuple]:
+    """(telegram_poll_id, chat_id, message_id) активных опросов, чей срок истёк, — самые старые первыми."""
+    res = await db.query(
+        "SELECT telegram_poll_id, chat_id, message_id FROM polls "
+        "WHERE active = 1 AND closes_at IS NOT NULL AND closes_at <= ? ORDER BY closes_at LIMIT ?",
+        (datetime.utcnow().isoformat(), limit),
+    )
+    return res or []
 
 
-def get_poll_by_tg_id(telegram_poll_id: str):
-    res = db_execute("SELECT id, options_json, category_id, active FROM polls WHERE telegram_poll_id = ?", (telegram_poll_id,), fetch=True)
+async def get_poll_by_tg_id(telegram_poll_id: str):
+    res = await db.query(
+        "SELECT id, options_json, category_id, active, closes_at FROM polls WHERE telegram_poll_id = ?",
+        (telegram_poll_id,),
+    )
     return res[0] if res else None
 
 
-def record_vote(telegram_poll_id: str, telegram_message_id: int, user_id: int, username: str, game_id: int, option_index: int):
-    now = datetime.utcnow().isoformat()
-    db_execute(
-        "INSERT INTO votes(telegram_poll_id, telegram_message_id, user_id, username, game_id, option_index, voted_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
-        (telegram_poll_id, telegram_message_id, user_id, username, game_id, option_index, now),
+async def current_data_version() -> int:
+    res = await db.query("SELECT version FROM data_version WHERE id = 1")
+    return res[0][0] if res else 0
+
+
+async def category_results(chat_id: int, category_id: int) -> List[Tuple]:
+    """Итоги категории чата: vote_tallies (открытые опросы) + poll_results (заархивированные).
+    [(game_id, title, votes)] по убыванию голосов. Стоимость — O(игр категории), от числа голосов не зависит."""
+    res = await db.query("""
+    SELECT g.id, g.title,
+           COALESCE((SELECT SUM(t.votes) FROM vote_tallies t WHERE t.category_id = g.category_id AND t.game_id = g.id), 0)
+           + COALESCE((SELECT SUM(r.votes) FROM poll_results r WHERE r.category_id = g.category_id AND r.game_id = g.id), 0)
+           AS total
+    FROM categories c
+    JOIN games g ON g.category_id = c.id
+    WHERE c.id = ? AND c.chat_id = ?
+    ORDER BY total DESC, g.id
+    """, (category_id, chat_id))
+    return res or []
+
+
+def _verify_and_rebuild_tallies(con: sqlite3.Connection) -> int:
+    # сравниваем агрегат с пересчётом по votes и пересобираем его; возвращаем число расхождений
+    mismatches = con.execute("""
+    WITH fresh AS (
+        SELECT telegram_poll_id, game_id, COUNT(*) AS votes FROM votes GROUP BY telegram_poll_id, game_id
+    )
+    SELECT COUNT(*) FROM (
+        SELECT f.telegram_poll_id FROM fresh f
+        LEFT JOIN vote_tallies t ON t.telegram_poll_id = f.telegram_poll_id AND t.game_id = f.game_id
+        WHERE t.votes IS NOT f.votes
+        UNION ALL
+        SELECT t.telegram_poll_id FROM vote_tallies t
+        LEFT JOIN fresh f ON t.telegram_poll_id = f.telegram_poll_id AND t.game_id = f.game_id
+        WHERE f.votes IS NULL AND t.votes != 0
     )
+    """).fetchone()[0]
+    _rebuild_tallies(con)
+    return mismatches
+
+
+async def rebuild_tallies() -> int:
+    """Пересобрать vote_tallies из таблицы votes. Возвращает число найденных расхождений."""
+    return await db.transaction(_verify_and_rebuild_tallies)
+
+
+# ---------- Поиск похожих названий игр ----------
+_TITLE_DROP_CHARS = frozenset("'’`´\u02bc")
+
+
+def normalize_title(title: str) -> str:
+    """Ключ сравнения названий: регистр, пунктуация и лишние пробелы не важны."""
+    title = unicodedata.normalize("NFKC", title).casefold()
+    title = "".join(ch for ch in title if ch not in _TITLE_DROP_CHARS)  # "Baldur's" == "Baldurs"
+    return " ".join("".join(ch if ch.isalnum() else " " for ch in title).split())
+
+
+def _trigrams(normalized: str) -> set:
+    padded = f"  {normalized} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class CategoryTitleIndex:
+    """Индекс названий одной категории: точное совпадение, префиксы (bisect) и триграммы."""
+
+    FREQUENT_GRAM = 2000  # триграмма чаще этого — слишком общая, чтобы по ней искать кандидатов
+
+    def __init__(self):
+        self.titles: Dict[int, str] = {}  # game_id -> исходное название
+        self.by_normalized: Dict[str, int] = {}
+        self.sorted_normalized: List[Tuple[str, int]] = []
+        self.postings: Dict[str, set] = {}  # триграмма -> {game_id}
+        self.sizes: Dict[int, int] = {}  # game_id -> число триграмм
+
+    def add(self, game_id: int, title: str):
+        normalized = normalize_title(title)
+        self.titles[game_id] = title
+        self.by_normalized.setdefault(normalized, game_id)
+        bisect.insort(self.sorted_normalized, (normalized, game_id))
+        grams = _trigrams(normalized)
+        self.sizes[game_id] = len(grams)
+        for gram in grams:
+            self.postings.setdefault(gram, set()).add(game_id)
+
+    def exact(self, title: str) -> Optional[str]:
+        game_id = self.by_normalized.get(normalize_title(title))
+        return self.titles[game_id] if game_id is not None else None
+
+    def _prefixed(self, normalized: str, limit: int) -> List[int]:
+        # все названия, начинающиеся с normalized (bisect по отсортированному списку)
+        found = []
+        i = bisect.bisect_left(self.sorted_normalized, (normalized, -1))
+        while i < len(self.sorted_normalized) and len(found) < limit:
+            other, game_id = self.sorted_normalized[i]
+            if not other.startswith(normalized):
+                break
+            found.append(game_id)
+            i += 1
+        return found
+
+    def _scored(self, normalized: str, min_score: float, containment: bool = False) -> List[Tuple[float, int]]:
+        # Жаккар по триграммам; containment — доля триграмм запроса (для коротких запросов автодополнения).
+        # В обоих случаях score >= min_score требует не меньше need общих триграмм (Жаккар не больше
+        # shared / len(grams)), поэтому кандидаты набираются только из len(grams) - need + 1 самых редких
+        # триграмм запроса, а по частым (вроде "  t" или " of") лишь досчитываются уже найденные —
+        # стоимость не растёт вместе с длинными списками частых триграмм
+        grams = sorted(_trigrams(normalized), key=lambda gram: len(self.postings.get(gram, ())))
+        need = max(1, math.ceil(min_score * len(grams) - 1e-9))
+        seed = len(grams) - need + 1
+        # частые триграммы (у большой доли названий) кандидатов не порождают, если в запросе есть редкие:
+        # совпадение только по "the"/" of" похожести не означает
+        seeds = [gram for gram in grams[:seed] if len(self.postings.get(gram, ())) <= self.FREQUENT_GRAM] or grams[:1]
+        rest = [gram for gram in grams if gram not in seeds]
+        shared: Dict[int, int] = {}
+        for gram in seeds:
+            for game_id in self.postings.get(gram, ()):
+                shared[game_id] = shared.get(game_id, 0) + 1
+        for i, gram in enumerate(rest):
+            posting = self.postings.get(gram, ())
+            left = len(rest) - i
+            # кто уже не доберёт need даже со всеми оставшимися триграммами — отбрасываем
+            shared = {gid: n + (gid in posting) for gid, n in shared.items() if n + left >= need}
+        if containment:
+            scored = [(n / len(grams), gid) for gid, n in shared.items()]
+        else:
+            scored = [(n / (len(grams) + self.sizes[gid] - n), gid) for gid, n in shared.items()]
+        scored = [item for item in scored if item[0] >= min_score]
+        scored.sort(key=lambda item: (-item[0], item[1]))
+        return scored
+
+    def similar(self, title: str, limit: int = 5) -> List[Tuple[int, str]]:
+        """Вероятные дубли: похожие по триграммам или продолжающие/продолжаемые по словам
+        ("Elden Ring" ~ "Elden Ring: Shadow of the Erdtree")."""
+        normalized = normalize_title(title)
+        if not normalized:
+            return []
+        ids = [gid for _, gid in self._scored(normalized, SIMILAR_TITLE_THRESHOLD)]
+        ids += self._prefixed(normalized + " ", limit)
+        words = normalized.split()
+        for n in range(len(words) - 1, 0, -1):
+            game_id = self.by_normalized.get(" ".join(words[:n]))
+            if game_id is not None:
+                ids.append(game_id)
+        unique = list(dict.fromkeys(ids))[:limit]
+        return [(gid, self.titles[gid]) for gid in unique]
+
+    def search(self, text: str, limit: int) -> List[Tuple[int, str]]:
+        """Для автодополнения: сначала по префиксу, затем по похожести."""
+        normalized = normalize_title(text)
+        if not normalized:
+            return [(gid, self.titles[gid]) for _, gid in self.sorted_normalized[:limit]]
+        ids = self._prefixed(normalized, limit)
+        if len(ids) < limit:
+            ids += [gid for _, gid in self._scored(normalized, 0.5, containment=True)[:limit]]
+        unique = list(dict.fromkeys(ids))[:limit]
+        return [(gid, self.titles[gid]) for gid in unique]
+
+
+class TitleIndex:
+    """Индексы названий по категориям: грузятся из БД при первом обращении, пополняются в add_game."""
+
+    def __init__(self):
+        self._categories: Dict[int, CategoryTitleIndex] = {}
+
+    async def category(self, category_id: int) -> CategoryTitleIndex:
+        index = self._categories.get(category_id)
+        if index is None:
+            index = CategoryTitleIndex()
+            for game_id, title, _ in await list_games_for_category(category_id):
+                index.add(game_id, title)
+            # пока шла загрузка, индекс мог уже появиться — берём первый
+            index = self._categories.setdefault(category_id, index)
+        return index
+
+    def add(self, category_id: int, game_id: int, title: str):
+        index = self._categories.get(category_id)
+        if index is not None and game_id not in index.titles:
+            index.add(game_id, title)
+
+    def invalidate(self, category_ids):
+        # после массового импорта проще перечитать затронутые категории при следующем обращении
+        for category_id in category_ids:
+            self._categories.pop(category_id, None)
+
+
+title_index = TitleIndex()
+
+
+# ---------- Кэш опросов для горячего пути голосования ----------
+class PollEntry:
+    """Разобранный mapping опроса: game_ids[option_index] -> game_id (0 — нет игры)."""
+    __slots__ = ("category_id", "game_ids", "active")
+
+    def __init__(self, category_id: int, game_ids: array, active: bool):
+        self.category_id = category_id
+        self.game_ids = game_ids
+        self.active = active
+
+    def game_id(self, option_index: int) -> Optional[int]:
+        if 0 <= option_index < len(self.game_ids):
+            return self.game_ids[option_index] or None
+        return None
+
+
+def _pack_options(options_map: Dict) -> array:
+    # ключи в options_json после json.dumps — строки, в памяти — int; нормализуем один раз
+    options = {int(k): int(v) for k, v in options_map.items()}
+    game_ids = array("q", [0]) * (max(options) + 1 if options else 0)
+    for opt_idx, game_id in options.items():
+        game_ids[opt_idx] = game_id
+    return game_ids
+
+
+def _deadline_ts(closes_at: Optional[str]) -> float:
+    # closes_at хранится как datetime.utcnow().isoformat()
+    if not closes_at:
+        return math.inf
+    return datetime.fromisoformat(closes_at).replace(tzinfo=timezone.utc).timestamp()
+
+
+class PollRegistry:
+    """Ограниченный LRU-кэш опросов по telegram_poll_id плюс полный набор открытых опросов.
+
+    Заполняется в publish_category_polls, обновляется в mark_polls_closed, а после
+    рестарта подгружает опрос из БД при первом обращении. На попадании
+    голос не делает ни одного чтения из БД и ни одного json.loads.
+    Набор открытых опросов (с дедлайнами) грузится целиком при старте:
+    ответ на закрытый, просроченный или неизвестный опрос отбрасывается
+    без обращения к БД.
+    """
 
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._entries: "OrderedDict[str, PollEntry]" = OrderedDict()
+        self._open: Dict[str, float] = {}  # telegram_poll_id -> дедлайн (unix time, inf — без срока)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def put(self, telegram_poll_id: str, category_id: int, options_map: Dict, active: bool = True,
+            closes_at: Optional[str] = None) -> PollEntry:
+        entry = PollEntry(category_id, _pack_options(options_map), bool(active))
+        self._entries[telegram_poll_id] = entry
+        self._entries.move_to_end(telegram_poll_id)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+        if active:
+            self._open[telegram_poll_id] = _deadline_ts(closes_at)
+        else:
+            self._open.pop(telegram_poll_id, None)
+        return entry
 
-def delete_votes_for_poll(telegram_poll_id: str):
-    db_execute("DELETE FROM votes WHERE telegram_poll_id = ?", (telegram_poll_id,))
+    def is_open(self, telegram_poll_id: str) -> bool:
+        return time.time() < self._open.get(telegram_poll_id, 0.0)
 
+    def open_count(self) -> int:
+        return len(self._open)
 
-def list_votes_for_category(category_id: int):
-    res = db_execute("""
-    SELECT v.user_id, v.username, g.title, c.title, v.voted_at
-    FROM votes v
-    LEFT JOIN games g ON v.game_id = g.id
-    LEFT JOIN categories c ON g.category_id = c.id
-    WHERE g.category_id = ?
-    ORDER BY v.voted_at
-    """, (category_id,), fetch=True)
-    return res or []
+    def mark_closed(self, telegram_poll_id: str):
+        self._open.pop(telegram_poll_id, None)
+        entry = self._entries.get(telegram_poll_id)
+        if entry is not None:
+            entry.active = False
 
+    async def load_open(self):
+        """Загрузить набор открытых опросов (вызывается при старте)."""
+        rows = await db.query("SELECT telegram_poll_id, closes_at FROM polls WHERE active = 1")
+        self._open = {tg_id: _deadline_ts(closes_at) for tg_id, closes_at in rows}
+        logger.info("Открытых опросов: %s", len(self._open))
 
-def list_all_votes():
-    res = db_execute("""
-    SELECT c.title AS category, g.title AS game, v.username, v.user_id, v.voted_at
-    FROM votes v
-    LEFT JOIN games g ON v.game_id = g.id
-    LEFT JOIN categories c ON g.category_id = c.id
-    ORDER BY c.id, g.id
-    """, fetch=True)
-    return res or []
+    async def get(self, telegram_poll_id: str) -> Optional[PollEntry]:
+        entry = self._entries.get(telegram_poll_id)
+        if entry is not None:
+            self._entries.move_to_end(telegram_poll_id)
+            return entry
+        pollrow = await get_poll_by_tg_id(telegram_poll_id)
+        if not pollrow:
+            return None
+        poll_db_id, options_json, category_id, active, closes_at = pollrow
+        return self.put(telegram_poll_id, category_id, json.loads(options_json), active, closes_at)
 
-# ---------- Telegram handlers & logic ----------
 
-# Стейты на время вводов (in-memory, per chat)
-# Для простоты: словарь chat_id -> state dict
-chat_states = {}
+poll_registry = PollRegistry(POLL_CACHE_SIZE)
+metrics.gauge("bot_poll_cache_entries", lambda: len(poll_registry))
+metrics.gauge("bot_open_polls", poll_registry.open_count)
+
+
+# ---------- Учёт применённых апдейтов (update_id) ----------
+UPDATE_ID_RESET_AFTER = timedelta(days=7)  # после недели без апдейтов Telegram начинает update_id заново
+
+
+class UpdateTracker:
+    """Какие update_id уже применены: отсекает повторную доставку и даёт «водяной знак» для БД.
+
+    floor — сохранённый в bot_state номер: всё, что не больше него, уже применено
+    до рестарта. Внутри процесса повторы ловятся по множеству недавних id.
+    watermark() — наибольший id, до которого включительно все начатые апдейты
+    обработаны; VoteIngestor сохраняет его в той же транзакции, что и голоса.
+    """
+
+    RECENT = 10000  # сколько недавних update_id помнить для дедупликации
+
+    def __init__(self):
+        self.floor = 0
+        self.persisted = 0
+        self._recent: set = set()
+        self._recent_order: List[int] = []
+        self._in_flight: set = set()
+        self._max_done = 0
+
+    def begin(self, update_id: int) -> bool:
+        """Отметить начало обработки; False — апдейт уже применялся."""
+        if update_id <= self.floor or update_id in self._recent:
+            return False
+        self._recent.add(update_id)
+        self._recent_order.append(update_id)
+        if len(self._recent_order) > 2 * self.RECENT:
+            for old in self._recent_order[:-self.RECENT]:
+                self._recent.discard(old)
+            del self._recent_order[:-self.RECENT]
+        self._in_flight.add(update_id)
+        return True
+
+    def done(self, update_id: int):
+        self._in_flight.discard(update_id)
+        self._max_done = max(self._max_done, update_id)
+
+    def watermark(self) -> int:
+        mark = self._max_done
+        if self._in_flight:
+            mark = min(mark, min(self._in_flight) - 1)
+        return max(mark, self.floor)
+
+    async def load(self):
+        rows = dict(await db.query("SELECT key, value FROM bot_state WHERE key IN ('last_update_id', 'last_update_at')"))
+        last_id, last_at = rows.get("last_update_id"), rows.get("last_update_at")
+        if last_id is None or last_at is None:
+            return
+        if datetime.utcnow() - datetime.fromisoformat(last_at) > UPDATE_ID_RESET_AFTER:
+            logger.info("Последний update_id сохранён больше недели назад — Telegram мог начать нумерацию заново, не используем")
+            return
+        self.floor = self.persisted = int(last_id)
+        logger.info("Последний применённый update_id: %s", self.floor)
+
+
+def _save_update_watermark(con: sqlite3.Connection, update_id: int):
+    con.executemany(
+        "INSERT INTO bot_state(key, value) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+        [("last_update_id", update_id), ("last_update_at", datetime.utcnow().isoformat())],
+    )
+
+
+update_tracker = UpdateTracker()
+
+
+# ---------- Приём голосов (write-behind) ----------
+def _apply_vote_batch(con: sqlite3.Connection, stale: List[Tuple[str, int, str]], rows: List[Tuple], watermark: Optional[int] = None):
+    # stale: (telegram_poll_id, user_id, json-список оставшихся option_index) — снимаем невыбранные варианты
+    con.executemany(
+        "DELETE FROM votes WHERE telegram_poll_id = ? AND user_id = ? AND option_index NOT IN (SELECT value FROM json_each(?))",
+        stale,
+    )
+    con.executemany(
+        "INSERT INTO votes(telegram_poll_id, telegram_message_id, user_id, username, game_id, option_index, voted_at) VALUES (?, ?, ?, ?, ?, ?, ?) "
+        "ON CONFLICT(telegram_poll_id, user_id, option_index) DO UPDATE SET "
+        "username = excluded.username, game_id = excluded.game_id, voted_at = excluded.voted_at",
+        rows,
+    )
+    if watermark is not None:
+        _save_update_watermark(con, watermark)
+
+
+class VoteIngestor:
+    """Очередь изменений голосов с отложенной пакетной записью.
+
+    poll_answer_handler только кладёт изменение в очередь и сразу возвращается.
+    Повторные изменения одного пользователя в одном опросе схлопываются
+    (побеждает последнее), а фоновый flusher пишет накопленное одной
+    транзакцией через executemany (UPSERT выбранных вариантов + снятие остальных) — по достижении flush_size изменений
+    или раз в flush_interval секунд. При остановке делается финальный flush.
+    В той же транзакции сохраняется водяной знак tracker — после рестарта
+    повторно доставленные апдейты с меньшим update_id не применяются дважды.
+    """
+
+    def __init__(self, database: Database, flush_size: int, flush_interval: float, tracker: Optional[UpdateTracker] = None):
+        self.db = database
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.tracker = tracker
+        # (telegram_poll_id, user_id) -> (username, [(option_index, game_id)], voted_at)
+        self._pending: Dict[Tuple[str, int], Tuple[str, List[Tuple[int, int]], str]] = {}
+        self._wakeup: Optional[asyncio.Event] = None
+        self._flush_lock: Optional[asyncio.Lock] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def __len__(self):
+        return len(self._pending)
+
+    def submit(self, telegram_poll_id: str, user_id: int, username: str, choices: List[Tuple[int, int]]):
+        """Поставить изменение голоса в очередь. Пустой choices — отзыв голоса."""
+        self._pending[(telegram_poll_id, user_id)] = (username, choices, datetime.utcnow().isoformat())
+        if self._wakeup is not None and len(self._pending) >= self.flush_size:
+            self._wakeup.set()
+
+    def start(self):
+        self._wakeup = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception:
+                # пачка уже возвращена в очередь — повторим на следующем тике
+                logger.exception("Не удалось записать пачку голосов, повторим позже")
+
+    async def flush(self) -> int:
+        """Записать всё накопленное одной транзакцией. Возвращает число изменений."""
+        async with self._flush_lock:
+            # водяной знак берём до того, как забрать пачку: все апдейты до него уже в очереди
+            watermark = self.tracker.watermark() if self.tracker is not None else None
+            if watermark is not None and watermark <= self.tracker.persisted:
+                watermark = None
+            if not self._pending and watermark is None:
+                return 0
+            batch, self._pending = self._pending, {}
+            stale = [
+                (poll_id, user_id, json.dumps([opt_idx for opt_idx, _ in choices]))
+                for (poll_id, user_id), (username, choices, voted_at) in batch.items()
+            ]
+            # message_id неизвестен в PollAnswer, пишем 0
+            rows = [
+                (poll_id, 0, user_id, username, game_id, opt_idx, voted_at)
+                for (poll_id, user_id), (username, choices, voted_at) in batch.items()
+                for opt_idx, game_id in choices
+            ]
+            try:
+                await self.db.transaction(_apply_vote_batch, stale, rows, watermark)
+            except BaseException:
+                # возвращаем пачку, не перетирая пришедшие за это время более свежие изменения
+                for key, value in batch.items():
+                    self._pending.setdefault(key, value)
+                raise
+            if watermark is not None:
+                self.tracker.persisted = watermark
+            metrics.inc("bot_vote_changes_flushed_total", len(stale))
+            logger.debug("Записано %s изменений голосов (%s строк)", len(stale), len(rows))
+            return len(stale)
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._flush_lock is None:
+            self._flush_lock = asyncio.Lock()
+        await self.flush()
+        # финальный checkpoint, чтобы всё записанное оказалось в основном файле БД
+        await self.db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+
+vote_ingestor = VoteIngestor(db, VOTE_FLUSH_SIZE, VOTE_FLUSH_INTERVAL, update_tracker)
+metrics.gauge("bot_vote_queue_depth", lambda: len(vote_ingestor))
+
+
+# ---------- Ограничение частоты запросов к Bot API ----------
+class TokenBucket:
+    """Классический token bucket: rate токенов в секунду, не больше capacity в запасе."""
+    __slots__ = ("rate", "capacity", "tokens", "updated", "lock")
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def is_full(self) -> bool:
+        self._refill()
+        return self.tokens >= self.capacity
+
+    async def acquire(self):
+        async with self.lock:  # ждущие получают токены по очереди
+            while True:
+                self._refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class RateLimiter:
+    """Лимиты Telegram на исходящие сообщения: общий на бота и отдельный на каждый чат.
+
+    Группы (chat_id < 0) — TG_GROUP_MSGS_PER_MIN сообщений в минуту с таким же запасом,
+    личные чаты — около одного в секунду, бот в целом — TG_GLOBAL_MSGS_PER_SEC.
+    На RetryAfter запрос повторяется после указанной паузы.
+    """
+
+    MAX_CHAT_BUCKETS = 1000  # сверх этого выбрасываем простаивающие (полные) вёдра
+
+    def __init__(self, global_rate: float, group_per_min: int, private_rate: float, max_retries: int = 3):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.group_per_min = group_per_min
+        self.private_rate = private_rate
+        self.max_retries = max_retries
+        self._chats: Dict[int, TokenBucket] = {}
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) >= self.MAX_CHAT_BUCKETS:
+                for idle in [cid for cid, b in self._chats.items() if b.is_full() and not b.lock.locked()]:
+                    del self._chats[idle]
+            if chat_id < 0:
+                bucket = TokenBucket(self.group_per_min / 60.0, self.group_per_min)
+            else:
+                bucket = TokenBucket(self.private_rate, 1)
+            self._chats[chat_id] = bucket
+        return bucket
+
+    async def call(self, chat_id: int, method: Callable, /, *args, **kwargs):
+        """Вызвать метод бота, адресованный в chat_id, с соблюдением лимитов."""
+        for attempt in range(self.max_retries + 1):
+            await self._chat_bucket(chat_id).acquire()
+            await self.global_bucket.acquire()
+            try:
+                return await method(*args, **kwargs)
+            except RetryAfter as e:
+                if attempt == self.max_retries:
+                    raise
+                delay = e.retry_after.total_seconds() if hasattr(e.retry_after, "total_seconds") else e.retry_after
+                logger.warning("Flood control в чате %s, ждём %s с", chat_id, delay)
+                await asyncio.sleep(delay)
+
+
+rate_limiter = RateLimiter(TG_GLOBAL_MSGS_PER_SEC, TG_GROUP_MSGS_PER_MIN, TG_PRIVATE_MSGS_PER_SEC)
+
+
+# ---------- Архив закрытых опросов ----------
+# Голоса закрытого опроса больше не меняются: их итоги сворачиваются в poll_results
+# (строка на опрос и игру), а сырые голоса переезжают в отдельный файл БД
+# (archive.archived_votes). Таблица votes остаётся размером с открытые опросы.
+ARCHIVE_BATCH = 50  # сколько опросов архивировать за одну пару транзакций
+
+
+def _create_archive_schema(con: sqlite3.Connection):
+    # id — тот же, что был в votes: повторное копирование после сбоя ничего не задвоит
+    con.execute("""
+    CREATE TABLE IF NOT EXISTS archive.archived_votes(
+        id INTEGER PRIMARY KEY,
+        telegram_poll_id TEXT,
+        telegram_message_id INTEGER,
+        user_id INTEGER,
+        username TEXT,
+        game_id INTEGER,
+        option_index INTEGER,
+        voted_at TEXT,
+        archived_at TEXT
+    )
+    """)
+    con.execute("CREATE INDEX IF NOT EXISTS archive.idx_archived_votes_game ON archived_votes(game_id)")
+    con.execute("CREATE INDEX IF NOT EXISTS archive.idx_archived_votes_poll ON archived_votes(telegram_poll_id)")
+
+
+def _copy_votes_to_archive(con: sqlite3.Connection, poll_ids_json: str):
+    con.execute("""
+    INSERT OR IGNORE INTO archive.archived_votes(
+        id, telegram_poll_id, telegram_message_id, user_id, username, game_id, option_index, voted_at, archived_at)
+    SELECT id, telegram_poll_id, telegram_message_id, user_id, username, game_id, option_index, voted_at, ?
+    FROM votes WHERE telegram_poll_id IN (SELECT value FROM json_each(?))
+    """, (datetime.utcnow().isoformat(), poll_ids_json))
+
+
+def _move_polls_to_summary(con: sqlite3.Connection, poll_ids_json: str):
+    # vote_tallies точны (ведутся триггерами), так что итоги берём из них, а не пересчитываем votes
+    con.execute("""
+    INSERT OR REPLACE INTO poll_results(telegram_poll_id, game_id, category_id, votes)
+    SELECT telegram_poll_id, game_id, category_id, votes FROM vote_tallies
+    WHERE telegram_poll_id IN (SELECT value FROM json_each(?)) AND votes > 0
+    """, (poll_ids_json,))
+    con.execute("DELETE FROM votes WHERE telegram_poll_id IN (SELECT value FROM json_each(?))", (poll_ids_json,))
+    # после удаления голосов триггер оставил здесь нули
+    con.execute("DELETE FROM vote_tallies WHERE telegram_poll_id IN (SELECT value FROM json_each(?))", (poll_ids_json,))
+    con.execute(
+        "UPDATE polls SET archived_at = ? WHERE telegram_poll_id IN (SELECT value FROM json_each(?))",
+        (datetime.utcnow().isoformat(), poll_ids_json),
+    )
+
+
+async def archive_polls(telegram_poll_ids: List[str]) -> int:
+    """Заархивировать закрытые опросы пачками по ARCHIVE_BATCH; вернуть их число.
+
+    На пачку две транзакции: сначала копия голосов в архив, затем в основной БД
+    итоги -> poll_results и удаление голосов. Коммит в WAL атомарен только в
+    пределах одного файла, поэтому порядок такой, чтобы сбой между ними оставлял
+    голоса в обоих местах (повтор безопасен), а не ни в одном."""
+    if not telegram_poll_ids:
+        return 0
+    await vote_ingestor.flush()  # голоса, принятые до закрытия, должны попасть в итоги
+    for i in range(0, len(telegram_poll_ids), ARCHIVE_BATCH):
+        batch = json.dumps(telegram_poll_ids[i:i + ARCHIVE_BATCH])
+        await db.transaction(_copy_votes_to_archive, batch)
+        await db.transaction(_move_polls_to_summary, batch)
+    metrics.inc("bot_polls_archived_total", len(telegram_poll_ids))
+    return len(telegram_poll_ids)
+
+
+async def archive_closed_polls() -> int:
+    """Доархивировать закрытые, но не заархивированные опросы (сбой, рестарт, базы до архива)."""
+    res = await db.query("SELECT telegram_poll_id FROM polls WHERE active = 0 AND archived_at IS NULL")
+    return await archive_polls([r[0] for r in res or []])
+
+
+# ---------- Публикация опросов ----------
+def _store_polls(con: sqlite3.Connection, rows: List[Tuple]):
+    con.executemany(
+        "INSERT INTO polls(telegram_poll_id, category_id, options_json, created_at, chat_id, message_id, closes_at) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?)",
+        rows,
+    )
+
+
+async def store_polls(category_id: int, chat_id: int, polls: List[Tuple[str, Dict[int, int], int]], closes_at: Optional[str] = None):
+    """Сохранить mapping-и нескольких опросов одной транзакцией. polls: [(telegram_poll_id, options_map, message_id)].
+    В poll_registry опросы регистрирует publish_category_polls — сразу после отправки каждого."""
+    now = datetime.utcnow().isoformat()
+    rows = [
+        (tg_poll_id, category_id, json.dumps(options_map), now, chat_id, message_id, closes_at)
+        for tg_poll_id, options_map, message_id in polls
+    ]
+    await db.transaction(_store_polls, rows)
+
+
+async def close_polls(bot, polls: List[Tuple]) -> int:
+    """Закрыть опросы: сразу перестать принимать голоса, пометить в БД одной транзакцией,
+    затем остановить их в Telegram (stop_poll) через rate_limiter и заархивировать.
+    polls: [(telegram_poll_id, chat_id, message_id)].
+    Возвращает число опросов, остановленных в Telegram."""
+    if not polls:
+        return 0
+    await mark_polls_closed([tg_poll_id for tg_poll_id, _, _ in polls])
+
+    async def stop(chat_id: int, message_id: int):
+        await rate_limiter.call(chat_id, bot.stop_poll, chat_id=chat_id, message_id=message_id)
+
+    # у опросов, созданных до появления chat_id/message_id, остановить в Telegram нечего
+    targets = [(chat_id, message_id) for _, chat_id, message_id in polls if chat_id is not None and message_id is not None]
+    results = await asyncio.gather(*(stop(*target) for target in targets), return_exceptions=True)
+    for (chat_id, message_id), r in zip(targets, results):
+        if isinstance(r, BaseException):
+            # уже закрыт вручную, сообщение удалено и т.п. — в БД опрос всё равно закрыт
+            logger.warning("stop_poll для сообщения %s в чате %s не удался: %s", message_id, chat_id, r)
+    await archive_polls([tg_poll_id for tg_poll_id, _, _ in polls])
+    return sum(1 for r in results if not isinstance(r, BaseException))
+
+
+async def close_expired_polls(bot) -> int:
+    """Закрыть все опросы с истёкшим сроком пачками по POLL_CLOSE_BATCH; вернуть их число."""
+    closed = 0
+    while True:
+        expired = await list_expired_polls(POLL_CLOSE_BATCH)
+        if not expired:
+            return closed
+        await close_polls(bot, expired)
+        closed += len(expired)
+        if len(expired) < POLL_CLOSE_BATCH:
+            return closed
+
+
+async def poll_deadline_job(context: ContextTypes.DEFAULT_TYPE):
+    """Периодическая задача JobQueue: закрытие опросов по сроку."""
+    closed = await close_expired_polls(context.bot)
+    if closed:
+        logger.info("Закрыто по сроку опросов: %s", closed)
+
+
+# варианты срока голосования при создании опросов: (подпись, секунд; 0 — без срока)
+POLL_DURATIONS = [("Без срока", 0), ("1 час", 3600), ("1 день", 86400), ("3 дня", 3 * 86400), ("Неделя", 7 * 86400)]
+
+
+async def publish_category_polls(bot, chat_id: int, cat_id: int, games: List[Tuple], reply_to, duration: int = 0):
+    """Разослать опросы категории (по MAX_POLL_OPTIONS игр в каждом) параллельно через rate_limiter.
+    duration — срок голосования в секундах (0 — пока не закроют вручную)."""
+    cat_title = await get_category_title(cat_id)
+    closes_at = (datetime.utcnow() + timedelta(seconds=duration)).isoformat() if duration else None
+    # один проход: кусок опций и его option_index -> game_id (одинаковые названия не путаются)
+    chunks = [games[i:i + MAX_POLL_OPTIONS] for i in range(0, len(games), MAX_POLL_OPTIONS)]
+
+    async def send(idx: int, chunk: List[Tuple]):
+        title_text = f"Голосование — {cat_title}"
+        if len(chunks) > 1:
+            title_text += f" (часть {idx}/{len(chunks)})"
+        # отправляем опрос (не анонимный)
+        message = await rate_limiter.call(
+            chat_id,
+            bot.send_poll,
+            chat_id=chat_id,
+            question=title_text,
+            options=[g[1] for g in chunk],
+            is_anonymous=False,
+            allows_multiple_answers=False,
+        )
+        options_map = {opt_index: g[0] for opt_index, g in enumerate(chunk)}
+        # регистрируем сразу: пока отправляются остальные куски (лимит группы — 20 в минуту),
+        # за этот опрос уже голосуют, и без записи в реестре ответы были бы отброшены
+        poll_registry.put(message.poll.id, cat_id, options_map, active=True, closes_at=closes_at)
+        return message.poll.id, options_map, message.message_id
+
+    results = await asyncio.gather(*(send(idx, chunk) for idx, chunk in enumerate(chunks, start=1)), return_exceptions=True)
+    sent = [r for r in results if not isinstance(r, BaseException)]
+    for r in results:
+        if isinstance(r, BaseException):
+            logger.error("Не удалось отправить опрос категории %s: %s", cat_id, r)
+    if sent:
+        await store_polls(cat_id, chat_id, sent, closes_at)
+    text = f"Отправлено {len(sent)} опрос(ов) для категории '{cat_title}'. Голосование активно"
+    text += f" до {closes_at[:16].replace('T', ' ')} UTC." if closes_at else "."
+    if len(sent) < len(chunks):
+        text += f"\nНе удалось отправить: {len(chunks) - len(sent)}."
+    await reply_to.reply_text(text)
+
+
+# ---------- Состояние диалогов (ожидаемые вводы) ----------
+class ConversationState:
+    """Ожидаемый ввод пользователя: kind ('awaiting_new_category', 'awaiting_game_for_cat', ...) и его аргумент."""
+    __slots__ = ("kind", "value", "expires_at")
+
+    def __init__(self, kind: str, value, expires_at: float):
+        self.kind = kind
+        self.value = value
+        self.expires_at = expires_at
+
+
+class ConversationStore:
+    """Состояния диалогов по (chat_id, user_id): TTL на запись, LRU-лимит по размеру
+    и (опционально) сквозная запись в таблицу conversation_state, чтобы
+    начатый ввод пережил передеплой. Ключ включает user_id — в группе чужое
+    сообщение не завершит ваш ввод."""
+
+    def __init__(self, database: Database, ttl: float, maxsize: int, persist: bool):
+        self.db = database
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.persist = persist
+        self._states: "OrderedDict[Tuple[int, int], ConversationState]" = OrderedDict()
+
+    def __len__(self):
+        return len(self._states)
+
+    def get(self, chat_id: int, user_id: int) -> Optional[ConversationState]:
+        key = (chat_id, user_id)
+        state = self._states.get(key)
+        if state is None:
+            return None
+        if state.expires_at <= time.time():
+            # просрочено; строка в БД отфильтруется при загрузке
+            del self._states[key]
+            return None
+        self._states.move_to_end(key)
+        return state
+
+    async def set(self, chat_id: int, user_id: int, kind: str, value=None):
+        key = (chat_id, user_id)
+        state = ConversationState(kind, value, time.time() + self.ttl)
+        self._states[key] = state
+        self._states.move_to_end(key)
+        evicted = []
+        while len(self._states) > self.maxsize:
+            evicted.append(self._states.popitem(last=False)[0])
+        if self.persist:
+            await self.db.execute(
+                "INSERT OR REPLACE INTO conversation_state(chat_id, user_id, kind, value, expires_at) VALUES (?, ?, ?, ?, ?)",
+                (chat_id, user_id, kind, value, state.expires_at),
+            )
+            if evicted:
+                await self.db.executemany("DELETE FROM conversation_state WHERE chat_id = ? AND user_id = ?", evicted)
+
+    def has_pending(self, user_id: int, kind: str, value) -> bool:
+        """Ждём ли от пользователя ввод kind с аргументом value — в любом чате.
+        Для inline-запросов, у которых нет чата; проход по всем записям (не больше maxsize)."""
+        now = time.time()
+        return any(
+            key[1] == user_id and state.kind == kind and state.value == value and state.expires_at > now
+            for key, state in self._states.items()
+        )
+
+    async def pop(self, chat_id: int, user_id: int) -> Optional[ConversationState]:
+        state = self.get(chat_id, user_id)
+        if state is not None:
+            del self._states[(chat_id, user_id)]
+            if self.persist:
+                await self.db.execute(
+                    "DELETE FROM conversation_state WHERE chat_id = ? AND user_id = ?", (chat_id, user_id)
+                )
+        return state
+
+    async def load(self):
+        """Поднять из БД незавершённые вводы (после рестарта), просроченные удалить."""
+        if not self.persist:
+            return
+        now = time.time()
+        await self.db.execute("DELETE FROM conversation_state WHERE expires_at <= ?", (now,))
+        rows = await self.db.query(
+            "SELECT chat_id, user_id, kind, value, expires_at FROM conversation_state ORDER BY expires_at DESC LIMIT ?",
+            (self.maxsize,),
+        )
+        for chat_id, user_id, kind, value, expires_at in reversed(rows):
+            self._states[(chat_id, user_id)] = ConversationState(kind, value, expires_at)
+
+
+conversation_store = ConversationStore(db, CONV_STATE_TTL, CONV_STATE_MAX, CONV_STATE_PERSIST)
+metrics.gauge("bot_conversation_states", lambda: len(conversation_store))
+
+
+# ---------- Клавиатуры категорий ----------
+# Компактный callback_data (лимит Bot API — 64 байта): "<код>:<id в base36>",
+# листание — "pg:<код>:<страница в base36>". expand_callback_data разворачивает их
+# в привычные "suggest_game_cat:<id>" и т.п.; старые кнопки в чатах продолжают работать.
+CB_SUGGEST_GAME_CAT = "sg"
+CB_CREATE_POLL_CAT = "cp"
+CB_RESULTS_CAT = "rs"
+CB_CLOSE_CAT = "cc"
+CB_PAGE = "pg"
+CALLBACK_ACTIONS = {
+    CB_SUGGEST_GAME_CAT: "suggest_game_cat",
+    CB_CREATE_POLL_CAT: "create_poll_cat",
+    CB_RESULTS_CAT: "results_cat",
+    CB_CLOSE_CAT: "close_cat",
+}
+_B36_DIGITS = "0123456789abcdefghijklmnopqrstuvwxyz"
+
+
+def to_base36(n: int) -> str:
+    if n == 0:
+        return "0"
+    digits = []
+    while n:
+        n, r = divmod(n, 36)
+        digits.append(_B36_DIGITS[r])
+    return "".join(reversed(digits))
+
+
+def expand_callback_data(data: str) -> str:
+    parts = data.split(":")
+    try:
+        if len(parts) == 2 and parts[0] in CALLBACK_ACTIONS:
+            return f"{CALLBACK_ACTIONS[parts[0]]}:{int(parts[1], 36)}"
+        if len(parts) == 3 and parts[0] == CB_PAGE and parts[1] in CALLBACK_ACTIONS:
+            return f"cat_page:{parts[1]}:{int(parts[2], 36)}"
+    except ValueError:
+        pass
+    return data
+
 
+class CategoryKeyboards:
+    """Кэш категорий чатов и постраничных клавиатур выбора категории (по PAGE_SIZE кнопок + навигация).
 
+    Список категорий чата читается из БД один раз и сбрасывается в add_category;
+    готовые страницы переиспользуются для всех нажатий. Хранятся MAX_CHATS
+    последних чатов (LRU).
+    """
+
+    PAGE_SIZE = 8
+    MAX_TITLE = 48  # длинные названия укорачиваем на кнопке
+    MAX_CHATS = 1000
+
+    def __init__(self):
+        # chat_id -> (категории чата, {(код, страница): клавиатура})
+        self._chats: "OrderedDict[int, Tuple[List[Tuple], Dict[Tuple[str, int], InlineKeyboardMarkup]]]" = OrderedDict()
+
+    def invalidate(self, chat_id: int):
+        self._chats.pop(chat_id, None)
+
+    async def _chat(self, chat_id: int):
+        entry = self._chats.get(chat_id)
+        if entry is None:
+            entry = (await list_categories(chat_id), {})
+            self._chats[chat_id] = entry
+            while len(self._chats) > self.MAX_CHATS:
+                self._chats.popitem(last=False)
+        else:
+            self._chats.move_to_end(chat_id)
+        return entry
+
+    async def categories(self, chat_id: int) -> List[Tuple]:
+        """[(id, title)] категорий чата."""
+        return (await self._chat(chat_id))[0]
+
+    async def page(self, chat_id: int, code: str, page: int) -> Optional[InlineKeyboardMarkup]:
+        """Страница page клавиатуры чата для действия code, None — если категорий нет."""
+        categories, pages_cache = await self._chat(chat_id)
+        if not categories:
+            return None
+        pages = (len(categories) + self.PAGE_SIZE - 1) // self.PAGE_SIZE
+        page = min(max(page, 0), pages - 1)
+        markup = pages_cache.get((code, page))
+        if markup is None:
+            markup = self._build(categories, code, page, pages)
+            pages_cache[(code, page)] = markup
+        return markup
+
+    def _build(self, categories: List[Tuple], code: str, page: int, pages: int) -> InlineKeyboardMarkup:
+        chunk = categories[page * self.PAGE_SIZE:(page + 1) * self.PAGE_SIZE]
+        kb = [
+            [InlineKeyboardButton(
+                title if len(title) <= self.MAX_TITLE else title[:self.MAX_TITLE - 1] + "…",
+                callback_data=f"{code}:{to_base36(cid)}",
+            )]
+            for cid, title in chunk
+        ]
+        if pages > 1:
+            nav = []
+            if page > 0:
+                nav.append(InlineKeyboardButton("◀️", callback_data=f"{CB_PAGE}:{code}:{to_base36(page - 1)}"))
+            nav.append(InlineKeyboardButton(f"{page + 1}/{pages}", callback_data="noop"))
+            if page < pages - 1:
+                nav.append(InlineKeyboardButton("▶️", callback_data=f"{CB_PAGE}:{code}:{to_base36(page + 1)}"))
+            kb.append(nav)
+        return InlineKeyboardMarkup(kb)
+
+
+category_keyboards = CategoryKeyboards()
+
+
+async def category_in_chat(chat_id: int, cat_id: int) -> bool:
+    # id категории приходит из callback_data/аргументов — проверяем, что она из этого чата
+    return any(cid == cat_id for cid, _ in await category_keyboards.categories(chat_id))
+
+
+async def close_polls_keyboard(chat_id: int, page: int) -> Optional[InlineKeyboardMarkup]:
+    """Страница списка активных опросов чата для закрытия (по CategoryKeyboards.PAGE_SIZE), None — если их нет."""
+    polls = await list_active_polls(chat_id)
+    if not polls:
+        return None
+    size = CategoryKeyboards.PAGE_SIZE
+    pages = (len(polls) + size - 1) // size
+    page = min(max(page, 0), pages - 1)
+    kb = [
+        [InlineKeyboardButton(f"Закрыть опрос #{poll_id}", callback_data=f"close_poll_id:{tg_poll_id}")]
+        for poll_id, tg_poll_id in polls[page * size:(page + 1) * size]
+    ]
+    if pages > 1:
+        nav = []
+        if page > 0:
+            nav.append(InlineKeyboardButton("◀️", callback_data=f"close_poll_page:{page - 1}"))
+        nav.append(InlineKeyboardButton(f"{page + 1}/{pages}", callback_data="noop"))
+        if page < pages - 1:
+            nav.append(InlineKeyboardButton("▶️", callback_data=f"close_poll_page:{page + 1}"))
+        kb.append(nav)
+    return InlineKeyboardMarkup(kb)
+
+
+# ---------- Telegram handlers & logic ----------
+
+
+@instrumented
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Команда /start — приватно или в чате"""
     text = (
@@ -223,7 +1779,10 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "- Предложить категорию\n"
         "- Создать голосование (только для админа/создателя чата)\n"
         "- Закрыть голосование (только для админа)\n"
-        "- Экспорт результатов (только для админа)"
+        "- Экспорт результатов (только для админа)\n"
+        "- Текущие результаты (/results [category_id])\n"
+        "- Резервная копия базы на сервере (/backup, только для оператора бота)\n"
+        "- Импорт номинантов: админ присылает CSV/XLSX с колонками «категория, игра»"
     )
     keyboard = [
         [InlineKeyboardButton("📥 Предложить игру", callback_data="suggest_game")],
@@ -231,39 +1790,56 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         [InlineKeyboardButton("📊 Создать голосование", callback_data="create_poll")],
         [InlineKeyboardButton("🔒 Закрыть голосование", callback_data="close_poll")],
         [InlineKeyboardButton("📤 Экспорт данных", callback_data="export_data")],
+        [InlineKeyboardButton("🏆 Результаты", callback_data="results")],
     ]
     await update.effective_chat.send_message(text, reply_markup=InlineKeyboardMarkup(keyboard))
 
 
+@instrumented
 async def button_router(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Маршрутизация нажатий кнопок"""
     query = update.callback_query
     await query.answer()
-    data = query.data
+    data = expand_callback_data(query.data)
     chat_id = query.message.chat_id
     user = query.from_user
 
-    # Инициализируем стейт для чата
-    chat_states.setdefault(chat_id, {})
-
     if data == "suggest_game":
         # Выбираем категорию
-        cats = list_categories()
-        if not cats:
+        markup = await category_keyboards.page(chat_id, CB_SUGGEST_GAME_CAT, 0)
+        if markup is None:
             await query.message.reply_text("Пока нет категорий. Попросите добавить категорию (➕ Предложить категорию).")
             return
-        kb = []
-        for cid, title in cats:
-            kb.append([InlineKeyboardButton(title, callback_data=f"suggest_game_cat:{cid}")])
-        await query.message.reply_text("Выберите категорию для предложения игры:", reply_markup=InlineKeyboardMarkup(kb))
+        await query.message.reply_text("Выберите категорию для предложения игры:", reply_markup=markup)
 
     elif data.startswith("suggest_game_cat:"):
         cat_id = int(data.split(":", 1)[1])
-        chat_states[chat_id]['awaiting_game_for_cat'] = cat_id
-        await query.message.reply_text("Введите название игры (на английском желателен):")
+        if not await category_in_chat(chat_id, cat_id):
+            await query.message.reply_text("Такой категории в этом чате нет.")
+            return
+        await conversation_store.set(chat_id, user.id, 'awaiting_game_for_cat', cat_id)
+        # кнопка автодополнения: inline-поиск по уже предложенным играм этой категории
+        kb = [[InlineKeyboardButton("🔎 Найти среди предложенных", switch_inline_query_current_chat=f"#{cat_id} ")]]
+        await query.message.reply_text("Введите название игры (на английском желателен):", reply_markup=InlineKeyboardMarkup(kb))
+
+    elif data in ("dup_add", "dup_skip"):
+        # ответ на «похожая игра уже есть»
+        st = await conversation_store.pop(chat_id, user.id)
+        if st is None or st.kind != 'confirm_game_for_cat':
+            await query.message.reply_text("Время на подтверждение истекло. Предложите игру заново через /start.")
+            return
+        cat_id, title = json.loads(st.value)
+        if data == "dup_skip":
+            await query.message.reply_text("Не добавляем — голосуйте за уже предложенную игру.")
+            return
+        ok = await add_game(title, cat_id, user.id, user.full_name or user.username or str(user.id))
+        if ok:
+            await query.message.reply_text(f"Игра '{title}' предложена в категории '{await get_category_title(cat_id)}'.")
+        else:
+            await query.message.reply_text(f"Игра '{title}' уже есть в этой категории.")
 
     elif data == "suggest_category":
-        chat_states[chat_id]['awaiting_new_category'] = True
+        await conversation_store.set(chat_id, user.id, 'awaiting_new_category')
         await query.message.reply_text("Введите название новой категории (например: 'Лучшая RPG 2025 года'):")
 
     elif data == "create_poll":
@@ -271,129 +1847,265 @@ async def button_router(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if not await user_is_admin_in_chat(context, chat_id, user.id):
             await query.message.reply_text("Только админ/создатель чата может создавать голосование.")
             return
-        cats = list_categories()
-        if not cats:
+        markup = await category_keyboards.page(chat_id, CB_CREATE_POLL_CAT, 0)
+        if markup is None:
             await query.message.reply_text("Нет категорий для голосования. Добавьте хотя бы одну категорию.")
             return
-        kb = []
-        for cid, title in cats:
-            kb.append([InlineKeyboardButton(title, callback_data=f"create_poll_cat:{cid}")])
-        await query.message.reply_text("Выберите категорию для создания голосования:", reply_markup=InlineKeyboardMarkup(kb))
+        await query.message.reply_text("Выберите категорию для создания голосования:", reply_markup=markup)
 
     elif data.startswith("create_poll_cat:"):
         cat_id = int(data.split(":",1)[1])
+        # срок голосования — отдельным шагом
+        kb = [[InlineKeyboardButton(label, callback_data=f"poll_go:{cat_id}:{seconds}")] for label, seconds in POLL_DURATIONS]
+        await query.message.reply_text("Сколько будет идти голосование?", reply_markup=InlineKeyboardMarkup(kb))
+
+    elif data.startswith("poll_go:"):
+        if not await user_is_admin_in_chat(context, chat_id, user.id):
+            await query.message.reply_text("Только админ/создатель чата может создавать голосование.")
+            return
+        _, cat_id, duration = data.split(":")
+        cat_id = int(cat_id)
+        if not await category_in_chat(chat_id, cat_id):
+            await query.message.reply_text("Такой категории в этом чате нет.")
+            return
         # Получаем кандидатов
-        games = list_games_for_category(cat_id)
+        games = await list_games_for_category(cat_id)
         if not games:
             await query.message.reply_text("В этой категории нет предложенных игр. Попросите участников предложить игры.")
             return
-        # Формируем опции (учитывая лимит)
-        options = [g[1] for g in games]  # title
-        # если больше MAX_POLL_OPTIONS - делим на несколько опросов (пагинация)
-        chunks = [options[i:i+MAX_POLL_OPTIONS] for i in range(0, len(options), MAX_POLL_OPTIONS)]
-        # Мы отправляем серию опросов и запоминаем mapping опция->game_id для каждого poll
-        sent_info = []
-        for idx, chunk in enumerate(chunks, start=1):
-            # find corresponding game ids for chunk
-            option_to_gameid = {}
-            for opt_index, opt_text in enumerate(chunk):
-                # find game_id
-                for g in games:
-                    if g[1] == opt_text:
-                        option_to_gameid[opt_index] = g[0]
-                        break
-            # текст заголовка
-            title_text = f"Голосование — {get_category_title(cat_id)}"
-            if len(chunks) > 1:
-                title_text += f" (часть {idx}/{len(chunks)})"
-            # отправляем опрос (не анонимный)
-            message = await context.bot.send_poll(
-                chat_id=chat_id,
-                question=title_text,
-                options=chunk,
-                is_anonymous=False,
-                allows_multiple_answers=False,
-            )
-            # Сохраняем mapping между telegram_poll.id и game ids
-            tg_poll_id = message.poll.id  # уникальный идентификатор опроса
-            # map option_index -> game_id
-            store_poll(tg_poll_id, cat_id, option_to_gameid)
-            sent_info.append((tg_poll_id, message.message_id))
-        await query.message.reply_text(f"Отправлено {len(sent_info)} опрос(ов) для категории '{get_category_title(cat_id)}'. Голосование активно.")
+        # отправка идёт в фоне через лимитер — хендлер не ждёт пауз flood-control
+        context.application.create_task(publish_category_polls(context.bot, chat_id, cat_id, games, query.message, int(duration)))
 
     elif data == "close_poll":
         if not await user_is_admin_in_chat(context, chat_id, user.id):
             await query.message.reply_text("Только админ/создатель чата может закрыть голосование.")
             return
         # Предложим список активных опросов из polls
-        res = db_execute("SELECT id, telegram_poll_id FROM polls WHERE active=1", fetch=True)
-        if not res:
+        markup = await close_polls_keyboard(chat_id, 0)
+        if markup is None:
             await query.message.reply_text("Нет активных опросов для закрытия.")
             return
-        kb = [[InlineKeyboardButton(f"Закрыть опрос #{row[0]}", callback_data=f"close_poll_id:{row[1]}")] for row in res]
-        await query.message.reply_text("Выберите опрос, который хотите закрыть:", reply_markup=InlineKeyboardMarkup(kb))
+        # закрытие по категории — отдельным сообщением, список опросов — постранично:
+        # у категории на 200 номинантов 20 опросов, и одна клавиатура быстро упёрлась бы в лимит Telegram
+        kb = [[InlineKeyboardButton("🔒 Все опросы категории", callback_data="close_by_category")]]
+        await query.message.reply_text("Закрыть сразу все опросы категории:", reply_markup=InlineKeyboardMarkup(kb))
+        await query.message.reply_text("Или выберите опрос, который хотите закрыть:", reply_markup=markup)
+
+    elif data.startswith("close_poll_page:"):
+        markup = await close_polls_keyboard(chat_id, int(data.split(":", 1)[1]))
+        if markup is not None:
+            await query.edit_message_reply_markup(reply_markup=markup)
 
     elif data.startswith("close_poll_id:"):
+        if not await user_is_admin_in_chat(context, chat_id, user.id):
+            await query.message.reply_text("Только админ/создатель чата может закрыть голосование.")
+            return
         tg_poll_id = data.split(":",1)[1]
-        # закрываем: пометим active=0
-        mark_poll_closed(tg_poll_id)
-        await query.message.reply_text("Опрос закрыт (помечен как неактивный).")
+        res = await db.query(
+            "SELECT telegram_poll_id, chat_id, message_id FROM polls WHERE telegram_poll_id = ? AND chat_id = ? AND active = 1",
+            (tg_poll_id, chat_id),
+        )
+        # закрываем: active=0 и stop_poll в Telegram
+        await close_polls(context.bot, res)
+        await query.message.reply_text("Опрос закрыт." if res else "Опрос уже закрыт.")
+
+    elif data == "close_by_category":
+        markup = await category_keyboards.page(chat_id, CB_CLOSE_CAT, 0)
+        if markup is None:
+            await query.message.reply_text("Категорий пока нет.")
+            return
+        await query.message.reply_text("Опросы какой категории закрыть?", reply_markup=markup)
+
+    elif data.startswith("close_cat:"):
+        if not await user_is_admin_in_chat(context, chat_id, user.id):
+            await query.message.reply_text("Только админ/создатель чата может закрыть голосование.")
+            return
+        cat_id = int(data.split(":", 1)[1])
+        polls = await list_active_polls_for_category(chat_id, cat_id)
+        if not polls:
+            await query.message.reply_text("В этой категории нет активных опросов.")
+            return
+
+        async def close_category():
+            await close_polls(context.bot, polls)
+            await query.message.reply_text(f"Закрыто опросов категории '{await get_category_title(cat_id)}': {len(polls)}.")
+
+        # stop_poll идут через лимитер — не держим хендлер
+        context.application.create_task(close_category())
+    elif data == "results":
+        markup = await category_keyboards.page(chat_id, CB_RESULTS_CAT, 0)
+        if markup is None:
+            await query.message.reply_text("Категорий пока нет.")
+            return
+        await query.message.reply_text("Результаты какой категории показать?", reply_markup=markup)
+
+    elif data == "noop":
+        pass
+
+    elif data.startswith("cat_page:"):
+        # листание клавиатуры категорий — правим разметку того же сообщения
+        _, code, page = data.split(":")
+        markup = await category_keyboards.page(chat_id, code, int(page))
+        if markup is not None:
+            await query.edit_message_reply_markup(reply_markup=markup)
+
+    elif data.startswith("results_cat:"):
+        cat_id = int(data.split(":", 1)[1])
+        await query.message.reply_text(await format_results(chat_id, cat_id))
+
     elif data == "export_data":
         # только админ
         if not await user_is_admin_in_chat(context, update.effective_chat.id, user.id):
             await query.message.reply_text("Только админ/создатель чата может экспортировать данные.")
             return
-        # Экспорт всех голосов, игр и категорий
-        await query.message.reply_text("Генерирую файлы экспорта... Подождите.")
-        # Генерируем файлы
-        export_folder = generate_exports()
-        await query.message.reply_text(f"Файлы экспортированы в папку: {export_folder}\nФайлы: votes.xlsx, votes.docx, votes.pdf")
+        kb = [[InlineKeyboardButton(fmt, callback_data=f"export_fmt:{fmt}")] for fmt in EXPORT_FORMATS]
+        kb.append([InlineKeyboardButton("Все форматы", callback_data="export_fmt:all")])
+        await query.message.reply_text("В каком формате выгрузить голоса?", reply_markup=InlineKeyboardMarkup(kb))
+
+    elif data.startswith("export_fmt:"):
+        if not await user_is_admin_in_chat(context, update.effective_chat.id, user.id):
+            await query.message.reply_text("Только админ/создатель чата может экспортировать данные.")
+            return
+        fmt = data.split(":", 1)[1]
+        formats = list(EXPORT_FORMATS) if fmt == "all" else [fmt]
+        if not set(formats) <= set(EXPORT_FORMATS):
+            await query.message.reply_text("Неизвестный формат экспорта.")
+            return
+        # Экспорт всех голосов, игр и категорий — в фоне, хендлер сразу освобождается
+        progress = await query.message.reply_text("Генерирую файлы экспорта... Подождите.")
+        context.application.create_task(deliver_export(context.bot, chat_id, progress, formats))
     else:
         await query.message.reply_text("Неопознанная команда кнопки.")
 
 
+class AdminCache:
+    """Кэш администраторов чатов (get_chat_administrators) с TTL.
+
+    Одновременные проверки в одном чате ждут один общий запрос к API.
+    ChatMember-апдейты правят кэш сразу (назначили/сняли админа), а если
+    Telegram временно не отвечает — используется последний известный список.
+    """
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self._entries: Dict[int, Tuple[float, set]] = {}  # chat_id -> (когда загружен, {user_id})
+        self._inflight: Dict[int, asyncio.Task] = {}
+
+    async def admins(self, bot, chat_id: int) -> set:
+        entry = self._entries.get(chat_id)
+        if entry is not None and time.monotonic() - entry[0] < self.ttl:
+            return entry[1]
+        task = self._inflight.get(chat_id)
+        if task is None:
+            task = asyncio.create_task(self._fetch(bot, chat_id))
+            self._inflight[chat_id] = task
+        try:
+            return await asyncio.shield(task)
+        except Exception as e:
+            if entry is None:
+                raise
+            logger.warning("Не удалось обновить список админов чата %s, используем кэш: %s", chat_id, e)
+            return entry[1]
+
+    async def _fetch(self, bot, chat_id: int) -> set:
+        try:
+            members = await bot.get_chat_administrators(chat_id)  # включает creator
+            admins = {m.user.id for m in members}
+            self._entries[chat_id] = (time.monotonic(), admins)
+            return admins
+        finally:
+            self._inflight.pop(chat_id, None)
+
+    def apply_member_update(self, chat_id: int, user_id: int, status: str):
+        entry = self._entries.get(chat_id)
+        if entry is None:
+            return
+        if status in ("creator", "administrator"):
+            entry[1].add(user_id)
+        else:
+            entry[1].discard(user_id)
+
+    def invalidate(self, chat_id: int):
+        self._entries.pop(chat_id, None)
+
+
+admin_cache = AdminCache(ADMIN_CACHE_TTL)
+
+
 async def user_is_admin_in_chat(context: ContextTypes.DEFAULT_TYPE, chat_id: int, user_id: int) -> bool:
     """Попытка проверить является ли пользователь админом/creator в чате.
        Если ADMIN_USER_IDS задан, проверяем там (в приоритете)."""
     if ADMIN_USER_IDS:
         return user_id in ADMIN_USER_IDS
     try:
-        member = await context.bot.get_chat_member(chat_id, user_id)
-        status = member.status  # 'creator', 'administrator', 'member', ...
-        return status in ("creator", "administrator")
+        return user_id in await admin_cache.admins(context.bot, chat_id)
     except Exception as e:
         logger.warning("Не удалось получить информацию о правах: %s", e)
         return False
 
 
-def get_category_title(cat_id: int) -> str:
-    res = db_execute("SELECT title FROM categories WHERE id = ?", (cat_id,), fetch=True)
+def user_is_operator(user_id: int) -> bool:
+    """Оператор бота — для команд, которые затрагивают все чаты. Админ группы им не является:
+    список берётся из OPERATOR_USER_IDS, а если он пуст — из ADMIN_USER_IDS."""
+    return user_id in (OPERATOR_USER_IDS or ADMIN_USER_IDS)
+
+
+@instrumented
+async def chat_member_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Изменения прав участников (chat_member) и самого бота (my_chat_member) — обновляем кэш админов."""
+    if update.my_chat_member is not None:
+        # бота добавили/удалили/повысили — проще перечитать список целиком
+        admin_cache.invalidate(update.my_chat_member.chat.id)
+        return
+    cmu = update.chat_member
+    admin_cache.apply_member_update(cmu.chat.id, cmu.new_chat_member.user.id, cmu.new_chat_member.status)
+
+
+async def get_category_title(cat_id: int) -> str:
+    res = await db.query("SELECT title FROM categories WHERE id = ?", (cat_id,))
     return res[0][0] if res else "Unknown"
 
 
+@instrumented
 async def text_message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Обработка вводимых пользователем названий игр и категорий (простая state-machine по chat_states)"""
+    """Обработка вводимых пользователем названий игр и категорий (простая state-machine по conversation_store)"""
     msg = update.message
     chat_id = update.effective_chat.id
     user = update.effective_user
     text = msg.text.strip()
-    chat_states.setdefault(chat_id, {})
 
-    st = chat_states[chat_id]
+    st = await conversation_store.pop(chat_id, user.id)
 
-    if st.get('awaiting_new_category'):
-        added = add_category(text, user.id, user.full_name or user.username or str(user.id))
-        st.pop('awaiting_new_category', None)
+    if st is not None and st.kind == 'awaiting_new_category':
+        added = await add_category(chat_id, text, user.id, user.full_name or user.username or str(user.id))
         if added:
             await msg.reply_text(f"Категория '{text}' добавлена.")
         else:
             await msg.reply_text(f"Категория '{text}' уже существует.")
 
-    elif 'awaiting_game_for_cat' in st:
-        cat_id = st.pop('awaiting_game_for_cat')
-        ok = add_game(text, cat_id, user.id, user.full_name or user.username or str(user.id))
+    elif st is not None and st.kind == 'awaiting_game_for_cat':
+        cat_id = st.value
+        index = await title_index.category(cat_id)
+        existing = index.exact(text)
+        if existing is not None:
+            await msg.reply_text(f"Игра '{existing}' уже есть в этой категории.")
+            return
+        similar = index.similar(text)
+        if similar:
+            await conversation_store.set(chat_id, user.id, 'confirm_game_for_cat', json.dumps([cat_id, text]))
+            kb = [
+                [InlineKeyboardButton("➕ Всё равно добавить", callback_data="dup_add")],
+                [InlineKeyboardButton("❌ Не добавлять", callback_data="dup_skip")],
+            ]
+            await msg.reply_text(
+                "Похожие игры уже предложены:\n" + "\n".join(f"- {title}" for _, title in similar)
+                + f"\nДобавить '{text}' как отдельную игру?",
+                reply_markup=InlineKeyboardMarkup(kb),
+            )
+            return
+        ok = await add_game(text, cat_id, user.id, user.full_name or user.username or str(user.id))
         if ok:
-            await msg.reply_text(f"Игра '{text}' предложена в категории '{get_category_title(cat_id)}'.")
+            await msg.reply_text(f"Игра '{text}' предложена в категории '{await get_category_title(cat_id)}'.")
         else:
             await msg.reply_text(f"Игра '{text}' уже есть в этой категории.")
     else:
@@ -401,74 +2113,214 @@ async def text_message_handler(update: Update, context: ContextTypes.DEFAULT_TYP
         await msg.reply_text("Если хотите предложить игру или категорию — используйте /start и кнопки.")
 
 
+@instrumented
+async def inline_query_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Inline-автодополнение названий: "@bot #<category_id> текст" (кнопка «Найти среди предложенных»).
+    Выбранный вариант отправляется обычным сообщением, и ввод игры распознаёт его как уже предложенную.
+    Inline-запрос не знает, из какого он чата, поэтому отвечаем только по категории, для которой
+    пользователь сейчас вводит игру (нажал «Предложить игру» в её чате), — чужие категории по id не читаются."""
+    inline_query = update.inline_query
+    text = inline_query.query.strip()
+    head, _, text = text[1:].partition(" ") if text.startswith("#") else ("", "", text)
+    cat_id = int(head) if head.isdigit() else None
+    if cat_id is None or not conversation_store.has_pending(inline_query.from_user.id, 'awaiting_game_for_cat', cat_id):
+        await inline_query.answer([], cache_time=10, is_personal=True)
+        return
+    cat_title = await get_category_title(cat_id)
+    results = [
+        InlineQueryResultArticle(
+            id=str(game_id),
+            title=title,
+            description=cat_title,
+            input_message_content=InputTextMessageContent(title),
+        )
+        for game_id, title in (await title_index.category(cat_id)).search(text, INLINE_RESULTS_LIMIT)
+    ]
+    # is_personal: иначе Telegram отдаст закэшированный ответ на тот же текст другим пользователям
+    await inline_query.answer(results, cache_time=10, is_personal=True)
+
+
+@instrumented
 async def poll_answer_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработка ответов на опросы — Telegram присылает PollAnswer, содержащий user и выбранные option_ids.
        Мы сохраняем в таблицу votes явный user->game mapping (на основе ранее сохранённого polls.options_json).
     """
-    answer = update.poll_answer  # telegram.PollAnswer
+    await accept_poll_answer(update.poll_answer)
+
+
+async def accept_poll_answer(answer: PollAnswer):
+    """Поставить ответ на опрос в очередь записи (общий путь для хендлера и догонялки после простоя)."""
     user = answer.user
     tg_poll_id = answer.poll_id
     chosen = answer.option_ids  # list of option indexes (0-based)
-    # получить mapping для этого poll
-    pollrow = get_poll_by_tg_id(tg_poll_id)
-    if not pollrow:
+    # закрытый, просроченный или чужой опрос — отбрасываем, не трогая БД
+    if not poll_registry.is_open(tg_poll_id):
+        metrics.inc("bot_votes_dropped_total")
+        logger.debug("Ответ на закрытый/неизвестный опрос %s отброшен", tg_poll_id)
+        return
+    # получить mapping для этого poll (из кэша, БД — только при промахе)
+    poll = await poll_registry.get(tg_poll_id)
+    if poll is None:
         logger.info("Получен ответ на неизвестный опрос %s", tg_poll_id)
         return
-    poll_db_id, options_json, category_id, active = pollrow
-    options_map = json.loads(options_json)  # option_index -> game_id
 
     # NOTE: update.poll_answer не содержит message_id; мы не знаем message_id здесь.
     # Но мы можем записать telegram_poll_id и user -> game
     # Для simplicity: запишем все выбранные варианты (Telegram может отправлять несколько если allows_multiple_answers=True).
-    # Удалим предыдущие голоса этого пользователя в этом poll (на случай изменения выбора)
-    db_execute("DELETE FROM votes WHERE telegram_poll_id = ? AND user_id = ?", (tg_poll_id, user.id))
-
+    # Предыдущие голоса этого пользователя в этом poll заменяются целиком (на случай изменения выбора)
+    choices = []
     for opt_idx in chosen:
-        game_id = options_map.get(str(opt_idx)) if isinstance(options_map.keys().__iter__().__next__(), str) else options_map.get(opt_idx)
-        # options_map might be stored with integer keys or string keys - normalize
-        if game_id is None:
-            # try string key
-            game_id = options_map.get(str(opt_idx))
+        game_id = poll.game_id(opt_idx)
         if game_id is None:
             logger.warning("Не могу найти game_id для option %s in poll %s", opt_idx, tg_poll_id)
             continue
-        # message_id unknown, set None (0)
-        record_vote(tg_poll_id, 0, user.id, user.full_name or user.username or str(user.id), game_id, opt_idx)
-    logger.info("Recorded vote(s) for user %s in poll %s", user.id, tg_poll_id)
+        choices.append((opt_idx, game_id))
+    # запись в БД делает фоновый flusher (UPSERT пачкой)
+    vote_ingestor.submit(tg_poll_id, user.id, user.full_name or user.username or str(user.id), choices)
+    logger.debug("Queued vote(s) for user %s in poll %s", user.id, tg_poll_id)
 
 
 # ---------- Export функций ----------
-def generate_exports(folder="exports"):
-    os.makedirs(folder, exist_ok=True)
-    # Excel
-    rows = list_all_votes()
-    if rows:
-        df = pd.DataFrame(rows, columns=["Category", "Game", "Username", "UserID", "VotedAt"])
-    else:
-        df = pd.DataFrame(columns=["Category", "Game", "Username", "UserID", "VotedAt"])
-    xlsx_path = os.path.join(folder, "votes.xlsx")
-    df.to_excel(xlsx_path, index=False)
+# Каждый формат строится отдельной функцией верхнего уровня: они выполняются
+# в процессах ExportManager и сами читают БД (read-only соединение), чтобы
+# не гонять строки голосов между процессами. Строки идут потоком кусками
+# по EXPORT_CHUNK_ROWS, так что для csv/xlsx/jsonl память не растёт с размером
+# таблицы votes. python-docx и reportlab держат весь документ в памяти до save(),
+# поэтому в docx/pdf попадают первые EXPORT_DOCUMENT_MAX_ROWS голосов и строка
+# о пропущенных. В экспорт попадают и голоса заархивированных опросов (archive.archived_votes).
+EXPORT_COLUMNS = ["Category", "Game", "Username", "UserID", "VotedAt"]
+EXPORT_CHUNK_ROWS = 1000
+
+
+def _iter_rows(db_path: str, query: str, params=()):
+    con = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+    try:
+        cur = con.execute(query, params)
+        while True:
+            chunk = cur.fetchmany(EXPORT_CHUNK_ROWS)
+            if not chunk:
+                break
+            yield from chunk
+    finally:
+        con.close()
+
+
+def _iter_chat_votes(db_path: str, chat_id: int):
+    """Голоса чата, текущие и архивные, в порядке категорий и игр:
+    (category_id, category, game_id, game, username, user_id, voted_at).
+    Голоса читаются по каждой игре через индексы по game_id: объединение votes
+    с архивом в одном запросе с сортировкой SQLite выполняет полным сканом."""
+    con = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+    try:
+        sources = ["votes"]
+        if os.path.exists(ARCHIVE_DB_PATH):
+            con.execute("ATTACH DATABASE ? AS archive", (f"file:{ARCHIVE_DB_PATH}?mode=ro",))
+            sources.insert(0, "archive.archived_votes")  # закрытые опросы раньше открытых
+        games = con.execute("""
+        SELECT c.id, c.title, g.id, g.title
+        FROM categories c
+        JOIN games g ON g.category_id = c.id
+        WHERE c.chat_id = ?
+        ORDER BY c.id, g.id
+        """, (chat_id,)).fetchall()
+        for cat_id, cat, game_id, game in games:
+            for source in sources:
+                cur = con.execute(f"SELECT username, user_id, voted_at FROM {source} WHERE game_id = ? ORDER BY id", (game_id,))
+                while True:
+                    chunk = cur.fetchmany(EXPORT_CHUNK_ROWS)
+                    if not chunk:
+                        break
+                    for username, uid, voted_at in chunk:
+                        yield cat_id, cat, game_id, game, username, uid, voted_at
+    finally:
+        con.close()
 
-    # Word (docx)
+
+def _iter_export_rows(db_path: str, chat_id: int):
+    # строки в порядке EXPORT_COLUMNS
+    for _, cat, _, game, username, uid, voted_at in _iter_chat_votes(db_path, chat_id):
+        yield cat, game, username, uid, voted_at
+
+
+def export_xlsx(db_path: str, folder: str, chat_id: int) -> str:
+    from openpyxl import Workbook
+
+    # write_only: строки сразу уходят во временный xml, а не копятся в листе
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet("Votes")
+    ws.append(EXPORT_COLUMNS)
+    for row in _iter_export_rows(db_path, chat_id):
+        ws.append(list(row))
+    xlsx_path = os.path.join(folder, "votes.xlsx")
+    wb.save(xlsx_path)
+    return xlsx_path
+
+
+def export_csv(db_path: str, folder: str, chat_id: int) -> str:
+    csv_path = os.path.join(folder, "votes.csv")
+    # utf-8-sig — чтобы Excel правильно открывал кириллицу
+    with open(csv_path, "w", newline="", encoding="utf-8-sig") as fh:
+        writer = csv.writer(fh)
+        writer.writerow(EXPORT_COLUMNS)
+        writer.writerows(_iter_export_rows(db_path, chat_id))
+    return csv_path
+
+
+def export_jsonl(db_path: str, folder: str, chat_id: int) -> str:
+    jsonl_path = os.path.join(folder, "votes.jsonl")
+    with open(jsonl_path, "w", encoding="utf-8") as fh:
+        for row in _iter_export_rows(db_path, chat_id):
+            fh.write(json.dumps(dict(zip(EXPORT_COLUMNS, row)), ensure_ascii=False))
+            fh.write("\n")
+    return jsonl_path
+
+
+def export_docx(db_path: str, folder: str, chat_id: int) -> str:
+    # python-docx держит документ в памяти целиком (отсюда лимит EXPORT_DOCUMENT_MAX_ROWS), голоса не группируем
+    # в словарь: строки идут упорядоченными по категории/игре, а число голосов берём из vote_tallies и poll_results
+    from docx import Document
+
+    counts = dict(_iter_rows(db_path, """
+    SELECT game_id, SUM(votes) FROM (
+        SELECT t.game_id, t.votes FROM categories c
+        JOIN vote_tallies t ON t.category_id = c.id
+        WHERE c.chat_id = ?
+        UNION ALL
+        SELECT r.game_id, r.votes FROM categories c
+        JOIN poll_results r ON r.category_id = c.id
+        WHERE c.chat_id = ?
+    )
+    GROUP BY game_id
+    """, (chat_id, chat_id)))
     doc = Document()
     doc.add_heading("Game Awards — Результаты голосования", level=1)
-    if rows:
-        # Группируем по категории -> game -> voters
-        grouped = {}
-        for cat, game, username, uid, voted_at in rows:
-            grouped.setdefault(cat, {}).setdefault(game, []).append((username, voted_at))
-        for cat, games in grouped.items():
-            doc.add_heading(cat, level=2)
-            for game, voters in games.items():
-                doc.add_paragraph(f"{game} — {len(voters)} голосов")
-                for username, voted_at in voters:
-                    doc.add_paragraph(f" - {username} ({voted_at})", style='List Bullet')
-    else:
+    no_group = object()
+    current_cat = current_game = no_group
+    rows = _iter_chat_votes(db_path, chat_id)
+    for shown, (cat_id, cat, game_id, game, username, _, voted_at) in enumerate(rows):
+        if shown == EXPORT_DOCUMENT_MAX_ROWS:
+            doc.add_paragraph(f"… и ещё {1 + sum(1 for _ in rows)} голосов — полный список в CSV/XLSX.")
+            break
+        if cat_id != current_cat:
+            doc.add_heading(str(cat), level=2)
+            current_cat, current_game = cat_id, None
+        if game_id != current_game:
+            doc.add_paragraph(f"{game} — {counts.get(game_id, 0)} голосов")
+            current_game = game_id
+        doc.add_paragraph(f" - {username} ({voted_at})", style='List Bullet')
+    if current_cat is no_group:
         doc.add_paragraph("Пока нет голосов.")
     docx_path = os.path.join(folder, "votes.docx")
     doc.save(docx_path)
+    return docx_path
+
 
-    # PDF (простая таблица)
+def export_pdf(db_path: str, folder: str, chat_id: int) -> str:
+    from reportlab.lib.pagesizes import A4
+    from reportlab.pdfgen import canvas
+
+    # PDF (простая таблица). Canvas держит все страницы в памяти до save(), поэтому
+    # печатаем не больше EXPORT_DOCUMENT_MAX_ROWS голосов
     pdf_path = os.path.join(folder, "votes.pdf")
     c = canvas.Canvas(pdf_path, pagesize=A4)
     width, height = A4
@@ -477,33 +2329,364 @@ def generate_exports(folder="exports"):
     c.drawString(50, y, "Game Awards — Результаты голосования")
     y -= 30
     c.setFont("Helvetica", 10)
-    if rows:
-        # печатаем шапку
-        c.drawString(50, y, "Категория")
-        c.drawString(220, y, "Игра")
-        c.drawString(380, y, "Пользователь")
-        c.drawString(520, y, "Время")
-        y -= 15
-        for r in rows:
-            if y < 60:
-                c.showPage()
-                y = height - 50
-            cat, game, username, uid, voted_at = r
-            c.drawString(50, y, str(cat)[:30])
-            c.drawString(220, y, str(game)[:30])
-            c.drawString(380, y, str(username)[:20])
-            c.drawString(520, y, str(voted_at)[:16])
-            y -= 12
-    else:
+    empty = True
+    rows = _iter_export_rows(db_path, chat_id)
+    for shown, (cat, game, username, uid, voted_at) in enumerate(rows):
+        if shown == EXPORT_DOCUMENT_MAX_ROWS:
+            c.drawString(50, y - 6, f"… и ещё {1 + sum(1 for _ in rows)} голосов — полный список в CSV/XLSX.")
+            break
+        if empty:
+            # печатаем шапку
+            c.drawString(50, y, "Категория")
+            c.drawString(220, y, "Игра")
+            c.drawString(380, y, "Пользователь")
+            c.drawString(520, y, "Время")
+            y -= 15
+            empty = False
+        if y < 60:
+            c.showPage()
+            c.setFont("Helvetica", 10)
+            y = height - 50
+        c.drawString(50, y, str(cat)[:30])
+        c.drawString(220, y, str(game)[:30])
+        c.drawString(380, y, str(username)[:20])
+        c.drawString(520, y, str(voted_at)[:16])
+        y -= 12
+    if empty:
         c.drawString(50, y, "Пока нет голосов.")
     c.save()
+    return pdf_path
+
+
+# Реестр форматов: формат -> сборщик(db_path, folder, chat_id) -> путь к файлу с голосами чата.
+# Сборщик — функция или строка "модуль:функция" (импортируется при первом использовании
+# в процессе экспорта), так что сторонний формат подключается без правки этого файла.
+ExportBuilder = Union[Callable[[str, str, int], str], str]
+EXPORT_FORMATS: Dict[str, ExportBuilder] = {}
+
+
+def register_export_format(fmt: str, builder: ExportBuilder):
+    EXPORT_FORMATS[fmt] = builder
+
+
+def run_export_builder(builder: ExportBuilder, db_path: str, folder: str, chat_id: int) -> str:
+    if isinstance(builder, str):
+        module_name, _, func_name = builder.partition(":")
+        builder = getattr(importlib.import_module(module_name), func_name)
+    return builder(db_path, folder, chat_id)
 
+
+for _fmt, _builder in (
+    ("xlsx", export_xlsx),
+    ("docx", export_docx),
+    ("pdf", export_pdf),
+    ("csv", export_csv),
+    ("jsonl", export_jsonl),
+):
+    if not EXPORT_FORMATS_ENABLED or _fmt in EXPORT_FORMATS_ENABLED:
+        register_export_format(_fmt, _builder)
+
+
+def generate_exports(chat_id: int, folder="exports"):
+    """Синхронно построить все форматы для чата (для запуска вне бота)."""
+    os.makedirs(folder, exist_ok=True)
+    for builder in EXPORT_FORMATS.values():
+        run_export_builder(builder, DB_PATH, folder, chat_id)
     return os.path.abspath(folder)
 
 
+class ExportManager:
+    """Кэш файлов экспорта по чатам, версионированный по содержимому БД, и фоновая сборка.
+
+    Каждый формат строится лениво — только когда его попросили, и только если
+    для чата и текущей data_version его ещё нет в manifest.json. Сборка идёт на пуле
+    процессов (openpyxl/python-docx/reportlab не держат event loop);
+    одновременные запросы одного (чат, версия, формат) ждут одно и то же задание.
+    У каждого чата хранятся файлы последних keep_versions версий, остальные удаляются.
+    """
+
+    def __init__(self, folder: str, max_workers: int, keep_versions: int):
+        self.folder = folder
+        self.max_workers = max_workers
+        self.keep_versions = keep_versions
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self._jobs: Dict[Tuple[int, int, str], asyncio.Task] = {}
+        self._manifest: Optional[Dict[str, Dict]] = None
+
+    def _executor(self) -> ProcessPoolExecutor:
+        if self._pool is None:
+            # spawn: не форкаем процесс с работающими потоками БД и event loop
+            self._pool = ProcessPoolExecutor(self.max_workers, mp_context=multiprocessing.get_context("spawn"))
+        return self._pool
+
+    @property
+    def manifest_path(self) -> str:
+        return os.path.join(self.folder, "manifest.json")
+
+    def _entries(self) -> Dict[str, Dict]:
+        # "чат:версия:формат" -> {"chat_id", "version", "format", "path" (относительно folder), "created_at"}
+        if self._manifest is None:
+            try:
+                with open(self.manifest_path, encoding="utf-8") as fh:
+                    # записи без chat_id — от общего для всех чатов экспорта, больше не используются
+                    self._manifest = {k: e for k, e in json.load(fh).items() if "chat_id" in e}
+            except (OSError, ValueError):
+                self._manifest = {}
+        return self._manifest
+
+    def _save_manifest(self):
+        os.makedirs(self.folder, exist_ok=True)
+        tmp_path = self.manifest_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as fh:
+            json.dump(self._entries(), fh, ensure_ascii=False, indent=1)
+        os.replace(tmp_path, self.manifest_path)
+
+    def _folder(self, chat_id: int, version: int) -> str:
+        return os.path.join(self.folder, f"c{chat_id}", f"v{version}")
+
+    def cached(self, chat_id: int, version: int, fmt: str) -> Optional[str]:
+        entry = self._entries().get(f"{chat_id}:{version}:{fmt}")
+        if entry is None:
+            return None
+        path = os.path.join(self.folder, entry["path"])
+        return path if os.path.exists(path) else None
+
+    async def get(self, chat_id: int, fmt: str) -> str:
+        """Путь к файлу формата fmt с голосами чата для текущих данных (собирается, только если устарел)."""
+        version = await current_data_version()
+        path = self.cached(chat_id, version, fmt)
+        if path is not None:
+            return path
+        key = (chat_id, version, fmt)
+        task = self._jobs.get(key)
+        if task is None:
+            task = asyncio.create_task(self._build(chat_id, version, fmt))
+            self._jobs[key] = task
+        return await asyncio.shield(task)
+
+    async def _build(self, chat_id: int, version: int, fmt: str) -> str:
+        try:
+            folder = self._folder(chat_id, version)
+            os.makedirs(folder, exist_ok=True)
+            loop = asyncio.get_running_loop()
+            path = await loop.run_in_executor(
+                self._executor(), run_export_builder, EXPORT_FORMATS[fmt], DB_PATH, folder, chat_id
+            )
+            self._entries()[f"{chat_id}:{version}:{fmt}"] = {
+                "chat_id": chat_id,
+                "version": version,
+                "format": fmt,
+                "path": os.path.relpath(path, self.folder),
+                "created_at": datetime.utcnow().isoformat(),
+            }
+            self._evict(chat_id)
+            self._save_manifest()
+            return path
+        finally:
+            self._jobs.pop((chat_id, version, fmt), None)
+
+    def _evict(self, chat_id: int):
+        entries = self._entries()
+        building = {version for job_chat, version, _ in self._jobs if job_chat == chat_id}
+        versions = {entry["version"] for entry in entries.values() if entry.get("chat_id") == chat_id}
+        for version in sorted(versions | building, reverse=True)[self.keep_versions:]:
+            if version in building:
+                continue
+            for key in [k for k, entry in entries.items() if entry.get("chat_id") == chat_id and entry["version"] == version]:
+                del entries[key]
+            shutil.rmtree(self._folder(chat_id, version), ignore_errors=True)
+
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+
+export_manager = ExportManager("exports", EXPORT_WORKERS, EXPORT_CACHE_VERSIONS)
+
+
+async def deliver_export(bot, chat_id: int, progress_message, formats: List[str]):
+    """Получить (из кэша или собрать) нужные форматы, показывать прогресс и прислать файлы запросившему."""
+    # экспорт должен видеть голоса, ещё лежащие в очереди записи
+    await vote_ingestor.flush()
+    done: List[str] = []
+
+    async def one(fmt: str) -> str:
+        path = await export_manager.get(chat_id, fmt)
+        done.append(fmt)
+        try:
+            await progress_message.edit_text(
+                f"Генерирую файлы экспорта... готово {len(done)}/{len(formats)} ({', '.join(done)})"
+            )
+        except Exception as e:
+            logger.warning("Не удалось сообщить о прогрессе экспорта: %s", e)
+        return path
+
+    try:
+        paths = await asyncio.gather(*(one(fmt) for fmt in formats))
+    except Exception as e:
+        logger.exception("Экспорт не удался")
+        await progress_message.edit_text(f"Не удалось сформировать экспорт: {e}")
+        return
+    for path in paths:
+        with open(path, "rb") as fh:
+            await bot.send_document(chat_id=chat_id, document=fh, filename=os.path.basename(path))
+
+
+# ---------- Импорт номинантов из CSV/XLSX ----------
+# Файл: две колонки «категория, игра», заголовок необязателен. Строка без игры
+# просто создаёт категорию. Файл читается потоком в отдельном потоке, всё
+# найденное пишется одной транзакцией (executemany), дубли — по normalize_title.
+IMPORT_EXTENSIONS = (".csv", ".xlsx")
+IMPORT_MAX_BYTES = 20 * 1024 * 1024  # больше Bot API скачать не даёт
+IMPORT_MAX_TITLE = 100  # длина варианта опроса в Telegram
+IMPORT_CATEGORY_HEADERS = {"category", "категория", "номинация"}
+IMPORT_GAME_HEADERS = {"game", "игра", "title", "название", "nominee", "номинант"}
+
+
+def _iter_import_rows(path: str):
+    """(номер строки, ячейки) из CSV или XLSX, не загружая файл в память целиком."""
+    if path.lower().endswith(".xlsx"):
+        from openpyxl import load_workbook
+
+        wb = load_workbook(path, read_only=True, data_only=True)
+        try:
+            for n, row in enumerate(wb.worksheets[0].iter_rows(values_only=True), start=1):
+                yield n, ["" if value is None else str(value) for value in row]
+        finally:
+            wb.close()
+        return
+    with open(path, newline="", encoding="utf-8-sig") as fh:
+        # Excel с русской локалью сохраняет CSV через ";"
+        try:
+            dialect = csv.Sniffer().sniff(fh.read(4096), delimiters=",;\t")
+        except csv.Error:
+            dialect = csv.excel
+        fh.seek(0)
+        yield from enumerate(csv.reader(fh, dialect), start=1)
+
+
+def parse_nominee_file(path: str) -> Tuple[List[Tuple[str, str]], List[str]]:
+    """Прочитать файл импорта: пары (категория, игра) и список проблемных строк."""
+    rows: List[Tuple[str, str]] = []
+    problems: List[str] = []
+    cat_col, game_col = 0, 1
+    for n, cells in _iter_import_rows(path):
+        cells = [cell.strip() for cell in cells]
+        if not any(cells):
+            continue
+        if not rows and not problems:
+            header = [cell.casefold() for cell in cells]
+            cat_cols = [i for i, h in enumerate(header) if h in IMPORT_CATEGORY_HEADERS]
+            game_cols = [i for i, h in enumerate(header) if h in IMPORT_GAME_HEADERS]
+            if cat_cols:
+                cat_col = cat_cols[0]
+                game_col = game_cols[0] if game_cols else cat_col + 1
+                continue
+        category = cells[cat_col] if cat_col < len(cells) else ""
+        game = cells[game_col] if game_col < len(cells) else ""
+        if not category:
+            problems.append(f"строка {n}: не указана категория")
+        elif len(category) > IMPORT_MAX_TITLE or len(game) > IMPORT_MAX_TITLE:
+            problems.append(f"строка {n}: название длиннее {IMPORT_MAX_TITLE} символов")
+        elif len(rows) >= IMPORT_MAX_ROWS:
+            problems.append(f"строка {n} и далее: больше {IMPORT_MAX_ROWS} строк, остальное не импортировано")
+            break
+        else:
+            rows.append((category, game))
+    return rows, problems
+
+
+def _import_nominees(con: sqlite3.Connection, chat_id: int, rows: List[Tuple[str, str]], user_id: int, user_name: str) -> Tuple[int, int, int, set]:
+    """Внутри одной транзакции: недостающие категории чата, затем новые игры.
+    Возвращает (категорий добавлено, игр добавлено, дублей пропущено, id затронутых категорий)."""
+    now = datetime.utcnow().isoformat()
+    categories_sql = "SELECT id, title FROM categories WHERE chat_id = ?"
+    categories = {normalize_title(title): cid for cid, title in con.execute(categories_sql, (chat_id,))}
+    new_categories: Dict[str, str] = {}
+    for category, _ in rows:
+        key = normalize_title(category)
+        if key not in categories:
+            new_categories.setdefault(key, category)
+    if new_categories:
+        con.executemany(
+            "INSERT INTO categories(chat_id, title, created_by, created_by_name, created_at) VALUES (?, ?, ?, ?, ?)",
+            [(chat_id, title, user_id, user_name, now) for title in new_categories.values()],
+        )
+        categories = {normalize_title(title): cid for cid, title in con.execute(categories_sql, (chat_id,))}
+
+    # покрывается индексом idx_games_category_normalized — таблицу games не читаем
+    existing = set(con.execute(
+        "SELECT category_id, normalized_title FROM games WHERE category_id IN (SELECT id FROM categories WHERE chat_id = ?)",
+        (chat_id,),
+    ))
+    new_games = []
+    duplicates = 0
+    for category, game in rows:
+        if not game:
+            continue
+        key = (categories[normalize_title(category)], normalize_title(game))
+        if key in existing:
+            duplicates += 1
+            continue
+        existing.add(key)
+        new_games.append((game, key[1], key[0], user_id, user_name, now))
+    con.executemany(
+        "INSERT INTO games(title, normalized_title, category_id, suggested_by, suggested_by_name, suggested_at) VALUES (?, ?, ?, ?, ?, ?)",
+        new_games,
+    )
+    return len(new_categories), len(new_games), duplicates, {row[2] for row in new_games}
+
+
+async def import_nominees(chat_id: int, rows: List[Tuple[str, str]], user_id: int, user_name: str) -> Tuple[int, int, int]:
+    added_categories, added_games, duplicates, touched = await db.transaction(_import_nominees, chat_id, rows, user_id, user_name)
+    if added_categories:
+        category_keyboards.invalidate(chat_id)
+    title_index.invalidate(touched)
+    return added_categories, added_games, duplicates
+
+
+@instrumented
+async def document_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Массовый импорт номинантов: админ присылает CSV/XLSX с колонками «категория, игра»."""
+    msg = update.message
+    doc = msg.document
+    user = update.effective_user
+    ext = os.path.splitext(doc.file_name or "")[1].lower()
+    if ext not in IMPORT_EXTENSIONS:
+        return
+    if not await user_is_admin_in_chat(context, update.effective_chat.id, user.id):
+        await msg.reply_text("Только админ/создатель чата может импортировать номинантов.")
+        return
+    if doc.file_size and doc.file_size > IMPORT_MAX_BYTES:
+        await msg.reply_text("Файл слишком большой: Telegram отдаёт ботам файлы до 20 МБ.")
+        return
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "import" + ext)
+        tg_file = await doc.get_file()
+        await tg_file.download_to_drive(path)
+        try:
+            rows, problems = await asyncio.to_thread(parse_nominee_file, path)
+        except Exception as e:
+            logger.warning("Не удалось разобрать файл импорта %s: %s", doc.file_name, e)
+            await msg.reply_text(f"Не удалось прочитать файл (нужен CSV в UTF-8 или XLSX): {e}")
+            return
+    added_categories, added_games, duplicates = await import_nominees(update.effective_chat.id, rows, user.id, user.full_name or user.username or str(user.id))
+    lines = [
+        f"Импорт из {doc.file_name} завершён.",
+        f"Добавлено категорий: {added_categories}, игр: {added_games}.",
+        f"Пропущено: {duplicates} дублей, {len(problems)} некорректных строк.",
+    ]
+    lines += problems[:10]
+    if len(problems) > 10:
+        lines.append(f"…и ещё {len(problems) - 10}")
+    await msg.reply_text("\n".join(lines))
+
+
 # ---------- Хелп команды ----------
+@instrumented
 async def list_categories_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    cats = list_categories()
+    cats = await list_categories(update.effective_chat.id)
     if not cats:
         await update.message.reply_text("Категорий пока нет.")
         return
@@ -511,6 +2694,7 @@ async def list_categories_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE
     await update.message.reply_text(text)
 
 
+@instrumented
 async def list_games_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Если вызов /list_games <category_id>
     args = context.args
@@ -522,41 +2706,384 @@ async def list_games_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     except:
         await update.message.reply_text("Неверный id категории.")
         return
-    games = list_games_for_category(cat_id)
+    if not await category_in_chat(update.effective_chat.id, cat_id):
+        await update.message.reply_text("Такой категории в этом чате нет.")
+        return
+    games = await list_games_for_category(cat_id)
     if not games:
         await update.message.reply_text("В этой категории пока нет игр.")
         return
-    text = f"Игры в категории {get_category_title(cat_id)}:\n" + "\n".join([f"{gid}. {title} (предложил: {who})" for gid, title, who in games])
+    text = f"Игры в категории {await get_category_title(cat_id)}:\n" + "\n".join([f"{gid}. {title} (предложил: {who})" for gid, title, who in games])
     await update.message.reply_text(text)
 
 
+RESULTS_TOP = 50  # сколько строк итогов показывать (лимит длины сообщения Telegram)
+
+
+async def format_results(chat_id: int, cat_id: int) -> str:
+    rows = await category_results(chat_id, cat_id)
+    if not rows:
+        return "В этой категории пока нет игр."
+    total = sum(votes for _, _, votes in rows)
+    lines = [f"{pos}. {title} — {votes}" for pos, (gid, title, votes) in enumerate(rows[:RESULTS_TOP], start=1)]
+    if len(rows) > RESULTS_TOP:
+        lines.append(f"…и ещё {len(rows) - RESULTS_TOP}")
+    return f"Результаты — {await get_category_title(cat_id)} (всего голосов: {total}):\n" + "\n".join(lines)
+
+
+@instrumented
+async def results_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # /results <category_id> — итоги категории; без аргумента — выбор категории кнопками
+    args = context.args
+    if not args:
+        markup = await category_keyboards.page(update.effective_chat.id, CB_RESULTS_CAT, 0)
+        if markup is None:
+            await update.message.reply_text("Категорий пока нет.")
+            return
+        await update.message.reply_text("Результаты какой категории показать?", reply_markup=markup)
+        return
+    try:
+        cat_id = int(args[0])
+    except ValueError:
+        await update.message.reply_text("Неверный id категории.")
+        return
+    await update.message.reply_text(await format_results(update.effective_chat.id, cat_id))
+
+
+@instrumented
+async def rebuild_results_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # /rebuild_results — сверить агрегат с таблицей votes и пересобрать его (только оператор: агрегат общий на все чаты)
+    if not user_is_operator(update.effective_user.id):
+        await update.message.reply_text("Только оператор бота (OPERATOR_USER_IDS) может пересчитывать результаты.")
+        return
+    await vote_ingestor.flush()
+    mismatches = await rebuild_tallies()
+    await update.message.reply_text(f"Результаты пересчитаны. Расхождений найдено: {mismatches}.")
+
+
+def _backup_database(src_path: str, dst_path: str):
+    # своё read-only соединение: backup() за один шаг копирует согласованный снимок,
+    # а в WAL чтение не блокирует поток БД, который продолжает писать голоса
+    src = sqlite3.connect(f"file:{src_path}?mode=ro", uri=True)
+    try:
+        dst = sqlite3.connect(dst_path)
+        try:
+            src.backup(dst)
+        finally:
+            dst.close()
+    finally:
+        src.close()
+
+
+def make_backup(folder: str, keep: int) -> List[str]:
+    """Снять копии основной БД и архива в folder/<время>/, оставить keep последних; вернуть пути файлов.
+
+    Основная БД копируется первой: архивация сначала дописывает архив и только потом
+    удаляет голоса из основной БД, так что в паре снимков голос может задвоиться
+    (id совпадают), но не потеряться."""
+    target = os.path.join(folder, datetime.utcnow().strftime("%Y%m%d-%H%M%S"))
+    os.makedirs(target, exist_ok=True)
+    paths = []
+    for path in (DB_PATH, ARCHIVE_DB_PATH):
+        if os.path.exists(path):
+            dst = os.path.join(target, os.path.basename(path))
+            _backup_database(path, dst)
+            paths.append(dst)
+    for old in sorted(os.listdir(folder))[:-max(keep, 1)]:
+        shutil.rmtree(os.path.join(folder, old), ignore_errors=True)
+    return paths
+
+
+@instrumented
+async def backup_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # /backup — онлайн-копия БД без остановки бота (только оператор). В чат файл не отправляем:
+    # в базе данные всех чатов
+    if not user_is_operator(update.effective_user.id):
+        await update.message.reply_text("Только оператор бота (OPERATOR_USER_IDS) может делать резервную копию.")
+        return
+    await vote_ingestor.flush()
+    try:
+        paths = await asyncio.to_thread(make_backup, BACKUP_DIR, BACKUP_KEEP)
+    except (OSError, sqlite3.Error) as e:
+        logger.exception("Не удалось сделать резервную копию")
+        await update.message.reply_text(f"Не удалось сделать резервную копию: {e}")
+        return
+    lines = [f"{path} — {os.path.getsize(path) / 1024:.0f} КБ" for path in paths]
+    await update.message.reply_text("Резервная копия сохранена на сервере:\n" + "\n".join(lines))
+
+
+# ---------- Параллельная обработка апдейтов ----------
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    """До max_concurrent_updates апдейтов одновременно, но внутри одного чата — строго по очереди.
+
+    Ключ очереди — чат апдейта, а для апдейтов без чата (poll_answer, inline_query) —
+    пользователь, так что и смена голоса одного человека применяется в порядке прихода.
+    """
+
+    def __init__(self, max_concurrent_updates: int):
+        super().__init__(max_concurrent_updates)
+        self._locks: Dict[Tuple[str, int], asyncio.Lock] = {}
+        self._waiters: Dict[Tuple[str, int], int] = {}
+
+    @staticmethod
+    def _key(update: object) -> Optional[Tuple[str, int]]:
+        if isinstance(update, Update):
+            if update.effective_chat is not None:
+                return ("chat", update.effective_chat.id)
+            if update.effective_user is not None:
+                return ("user", update.effective_user.id)
+        return None
+
+    async def process_update(self, update: object, coroutine: Awaitable):
+        # базовый process_update берёт слот семафора до do_process_update: апдейты, ждущие
+        # блокировку своего чата, держали бы слоты, и один занятой чат останавливал бы все.
+        # Поэтому сначала очередь чата, и только потом слот — на время самой обработки
+        key = self._key(update)
+        if key is None:
+            async with self._semaphore:
+                await self.do_process_update(update, coroutine)
+            return
+        lock = self._locks.get(key)
+        if lock is None:
+            lock = self._locks[key] = asyncio.Lock()
+        self._waiters[key] = self._waiters.get(key, 0) + 1
+        try:
+            async with lock:  # asyncio.Lock честный (FIFO) — порядок прихода сохраняется
+                async with self._semaphore:
+                    await self.do_process_update(update, coroutine)
+        finally:
+            self._waiters[key] -= 1
+            if not self._waiters[key]:
+                del self._waiters[key]
+                del self._locks[key]
+
+    async def do_process_update(self, update: object, coroutine: Awaitable):
+        await coroutine
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+
+def _format_histograms(title: str, rows: List[Tuple[str, Histogram]]) -> List[str]:
+    lines = [title]
+    for label, h in rows:
+        lines.append(
+            f"  {label[:60]}: n={h.count}, avg={h.sum / h.count * 1000:.1f} мс, p95≤{h.quantile(0.95) * 1000:g} мс"
+        )
+    return lines
+
+
+@instrumented
+async def stats_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # /stats — сводка метрик по всему боту (только оператор); полные данные — на METRICS_PORT в формате Prometheus
+    if not user_is_operator(update.effective_user.id):
+        await update.message.reply_text("Только оператор бота (OPERATOR_USER_IDS) может смотреть статистику.")
+        return
+    lines = [
+        f"Очередь голосов: {len(vote_ingestor)}, опросов в кэше: {len(poll_registry)}, "
+        f"ожидаемых вводов: {len(conversation_store)}",
+        f"Медленных запросов к БД (≥{SLOW_QUERY_MS:g} мс): {metrics.counter_value('bot_db_slow_queries_total'):g}, "
+        f"ошибок хендлеров: {metrics.counter_value('bot_handler_errors_total'):g}, "
+        f"ошибок Bot API: {metrics.counter_value('bot_api_errors_total'):g}",
+    ]
+    lines += _format_histograms("Хендлеры:", metrics.summary("bot_handler_seconds", "handler"))
+    lines += _format_histograms("Bot API:", metrics.summary("bot_api_seconds", "method"))
+    lines += _format_histograms("Запросы к БД (по суммарному времени):", metrics.summary("bot_db_query_seconds", "query", top=5))
+    await update.message.reply_text("\n".join(lines))
+
+
+metrics_server = MetricsServer("0.0.0.0", METRICS_PORT) if METRICS_PORT else None
+
+
+# ---------- Идемпотентность и догонялка после простоя ----------
+UPDATE_TRACK_START_GROUP = -100  # раньше всех хендлеров
+UPDATE_TRACK_DONE_GROUP = 1000  # позже всех, включая STARTUP_PROBE_GROUP
+CATCHUP_BATCH = 100  # максимум апдейтов в одном getUpdates
+
+
+async def track_update_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # повторно доставленный апдейт (рестарт, повтор вебхука) дальше не обрабатываем
+    if not update_tracker.begin(update.update_id):
+        metrics.inc("bot_updates_duplicate_total")
+        logger.debug("Апдейт %s уже применён, пропускаем", update.update_id)
+        raise ApplicationHandlerStop
+
+
+async def track_update_done(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    update_tracker.done(update.update_id)
+
+
+async def catch_up(app: Application) -> int:
+    """Разобрать апдейты, накопившиеся за простой, до запуска polling.
+
+    getUpdates читается пачками по CATCHUP_BATCH. Идущие подряд ответы на опросы
+    схлопываются до последнего на (опрос, пользователь) и пишутся одной транзакцией
+    в конце пачки, до запроса следующей; перед любым другим апдейтом накопленное
+    записывается раньше, так что порядок прихода
+    сохраняется (голоса до нажатия «Закрыть» попадают в итоги). Остальные апдейты
+    идут обычными хендлерами. Уже применённые пропускаются по update_id.
+    """
+    t0 = time.perf_counter()
+    latest: Dict[Tuple[str, int], PollAnswer] = {}
+    vote_update_ids: List[int] = []
+    received = votes = applied = 0
+    offset = None
+
+    async def apply_votes():
+        nonlocal votes, applied
+        for answer in latest.values():
+            await accept_poll_answer(answer)
+        for update_id in vote_update_ids:
+            update_tracker.done(update_id)
+        await vote_ingestor.flush()
+        votes += len(vote_update_ids)
+        applied += len(latest)
+        latest.clear()
+        vote_update_ids.clear()
+
+    while True:
+        # вызов со следующим offset заодно подтверждает Telegram предыдущую пачку
+        updates = await app.bot.get_updates(offset=offset, limit=CATCHUP_BATCH, timeout=0, allowed_updates=Update.ALL_TYPES)
+        if not updates:
+            break
+        received += len(updates)
+        offset = updates[-1].update_id + 1
+        for update in updates:
+            if update.poll_answer is None:
+                if latest:
+                    await apply_votes()
+                await app.process_update(update)  # дедупликация — в track_update_start
+            elif update_tracker.begin(update.update_id):
+                answer = update.poll_answer
+                latest[(answer.poll_id, answer.user.id)] = answer
+                vote_update_ids.append(update.update_id)
+            else:
+                metrics.inc("bot_updates_duplicate_total")
+        # следующий get_updates подтвердит эту пачку Telegram, и повторно она уже не придёт,
+        # поэтому её голоса записываем до него — рестарт посреди догонялки их не потеряет
+        await apply_votes()
+    if received:
+        logger.info(
+            "Догонялка: %s апдейтов (ответов на опросы %s, после схлопывания %s) за %.2f с",
+            received, votes, applied, time.perf_counter() - t0,
+        )
+    return received
+
+
 # ---------- Main ----------
+async def on_startup(app: Application):
+    vote_ingestor.start()
+    await conversation_store.load()
+    await poll_registry.load_open()
+    await update_tracker.load()
+    if CATCHUP_ON_START and not WEBHOOK_URL:
+        try:
+            await catch_up(app)
+        except Exception as e:
+            # например, Conflict, если у бота ещё висит вебхук, — тогда всё придёт обычным путём
+            logger.warning("Не удалось разобрать накопившиеся апдейты: %s", e)
+    archived = await archive_closed_polls()
+    if archived:
+        logger.info("Заархивировано закрытых опросов: %s", archived)
+    if app.job_queue is not None:
+        app.job_queue.run_repeating(poll_deadline_job, interval=POLL_DEADLINE_CHECK_INTERVAL, first=1, name="poll_deadlines")
+    else:
+        logger.warning("JobQueue недоступен (нужен python-telegram-bot[job-queue]) — опросы по сроку закрываться не будут")
+    if metrics_server is not None:
+        await metrics_server.start()
+    if STARTUP_PROFILE:
+        logger.info("STARTUP_PROFILE: приложение инициализировано через %.3f с", time.perf_counter() - _T_START)
+
+
+_first_update_logged = False
+
+
+async def first_update_probe(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # стоит в последней группе, т.е. срабатывает после основного хендлера; отрабатывает один раз.
+    # Хендлер не снимаем: process_update в этот момент обходит словарь групп, и remove_handler
+    # уронил бы цикл (и задачу получения апдейтов) с "dictionary changed size during iteration"
+    global _first_update_logged
+    if _first_update_logged:
+        return
+    _first_update_logged = True
+    logger.info("STARTUP_PROFILE: первый апдейт обработан через %.3f с после старта", time.perf_counter() - _T_START)
+
+
+STARTUP_PROBE_GROUP = 100
+first_update_probe_handler = TypeHandler(Update, first_update_probe)
+
+
+async def on_shutdown(app: Application):
+    # сначала дописываем очередь голосов, потом закрываем БД
+    if metrics_server is not None:
+        await metrics_server.stop()
+    export_manager.shutdown()
+    await vote_ingestor.stop()
+    # закрываем постоянное соединение с БД (поток БД завершится после текущих запросов)
+    await asyncio.get_running_loop().run_in_executor(None, db.close)
+
+
 def main():
     if not TOKEN:
         print("Ошибка: TELEGRAM_TOKEN не задан. Установите переменную окружения TELEGRAM_TOKEN.")
         return
 
+    if STARTUP_PROFILE:
+        logger.info("STARTUP_PROFILE: импорт модуля %.3f с", _T_IMPORTED - _T_START)
     init_db()
 
     # --- ИНИЦИАЛИЗАЦИЯ ДЛЯ PTB 20.X (ApplicationBuilder) ---
-    app = Application.builder().token(TOKEN).build() # <--- Использовать Application
+    builder = Application.builder().token(TOKEN).post_init(on_startup).post_shutdown(on_shutdown) # <--- Использовать Application
+    # все вызовы Bot API (кроме getUpdates) идут через инструментированный HTTP-клиент
+    builder = builder.request(InstrumentedRequest(connection_pool_size=256))
+    if CONCURRENT_UPDATES > 1:
+        builder = builder.concurrent_updates(ChatOrderedUpdateProcessor(CONCURRENT_UPDATES))
+    app = builder.build()
 
     # Handlers
+    app.add_handler(TypeHandler(Update, track_update_start), group=UPDATE_TRACK_START_GROUP)
+    app.add_handler(TypeHandler(Update, track_update_done), group=UPDATE_TRACK_DONE_GROUP)
     app.add_handler(CommandHandler("start", start))
     app.add_handler(CommandHandler("list_categories", list_categories_cmd))
     app.add_handler(CommandHandler("list_games", list_games_cmd))
+    app.add_handler(CommandHandler("results", results_cmd))
+    app.add_handler(CommandHandler("rebuild_results", rebuild_results_cmd))
+    app.add_handler(CommandHandler("backup", backup_cmd))
+    app.add_handler(CommandHandler("stats", stats_cmd))
     app.add_handler(CallbackQueryHandler(button_router))
     # В PTB 20.x PollAnswerHandler не нужен, MessageHandler с фильтром UpdateType.POLL_ANSWER не работает
     # Мы используем специальный хендлер PollAnswerHandler
     from telegram.ext import PollAnswerHandler
     app.add_handler(PollAnswerHandler(poll_answer_handler))
+    app.add_handler(ChatMemberHandler(chat_member_handler, ChatMemberHandler.ANY_CHAT_MEMBER))
+    # inline-режим нужно включить у @BotFather (/setinline)
+    app.add_handler(InlineQueryHandler(inline_query_handler))
     
+    app.add_handler(MessageHandler(filters.Document.FileExtension("csv") | filters.Document.FileExtension("xlsx"), document_handler))
+
     # Должен быть последним, чтобы обработать обычный текст
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, text_message_handler))
+    if STARTUP_PROFILE:
+        app.add_handler(first_update_probe_handler, group=STARTUP_PROBE_GROUP)
     
     print("Bot started...")
-    # --- ЗАПУСК ДЛЯ PTB 20.X (run_polling) ---
-    app.run_polling(poll_interval=1.0) # <--- Запуск через Application
+    # chat_member по умолчанию не присылается — запрашиваем все типы апдейтов
+    if WEBHOOK_URL:
+        # встроенный HTTP-сервер PTB; заголовок X-Telegram-Bot-Api-Secret-Token сверяется с WEBHOOK_SECRET
+        app.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=WEBHOOK_PATH,
+            webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}",
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=Update.ALL_TYPES,
+        )
+    else:
+        # --- ЗАПУСК ДЛЯ PTB 20.X (run_polling) ---
+        app.run_polling(poll_interval=POLL_INTERVAL, allowed_updates=Update.ALL_TYPES) # <--- Запуск через Application
     
 if __name__ == "__main__":
     main()